@@ -0,0 +1,97 @@
+import asyncio
+
+import metrics
+from logger import logger
+
+COALESCED = metrics.REGISTRY.counter(
+    "forwarder_coalesced_fills_total", "Fills folded into a digest instead of being sent on their own.")
+
+
+class _Fills(object):
+    __slots__ = ("last", "qty", "notional", "count", "timer")
+
+    def __init__(self, o):
+        self.last = o
+        self.qty = 0
+        self.notional = 0.0
+        self.count = 0
+        self.timer = None
+
+    def add(self, o):
+        qty = o.get("lastQty") or 0
+        price = o.get("lastPx") or o.get("price") or 0
+        self.last = o
+        self.qty += qty
+        self.notional += qty * price
+        self.count += 1
+
+    def digest(self):
+        if self.count == 1:
+            return self.last
+        o = dict(self.last)
+        # cumQty and avgPx of BitMEX cover the whole order, the digest only its window
+        o["fills"] = self.count
+        o["digestQty"] = self.qty
+        o["digestAvgPx"] = self.notional / self.qty if self.qty else o.get("price")
+        return o
+
+
+class FillAggregator(object):
+    """
+    Coalesce the fills of an order into one digest.
+
+    Trade executions are kept per (account, orderID) until the order is Filled
+    or window seconds passed since its first fill; the digest is the last
+    execution with fills, cumQty and avgPx (VWAP) added. Any other execution of
+    the order releases its pending digest first, so the order of the
+    notifications is kept. emit(channel, o) receives the digests released by
+    the timer, add() returns what is released right away.
+    """
+
+    def __init__(self, window, emit, logger=logger):
+        self.window = window
+        self.emit = emit
+        self.logger = logger
+        self.pending = {}
+        self.coalesced = COALESCED.labels()
+
+    def add(self, channel, o):
+        if not self.window:
+            return [o]
+
+        key = (channel, o.get("orderID"))
+        if o.get("execType") != "Trade":
+            fills = self._pop(key)
+            return [fills.digest(), o] if fills is not None else [o]
+
+        fills = self.pending.get(key)
+        if fills is None:
+            fills = self.pending[key] = _Fills(o)
+            fills.timer = asyncio.get_event_loop().call_later(self.window, self._expire, key, channel)
+        else:
+            self.coalesced.inc()
+        fills.add(o)
+
+        if o.get("ordStatus") == "Filled":
+            return [self._pop(key).digest()]
+        return []
+
+    def _pop(self, key):
+        fills = self.pending.pop(key, None)
+        if fills is not None and fills.timer is not None:
+            fills.timer.cancel()
+        return fills
+
+    def _expire(self, key, channel):
+        fills = self.pending.pop(key, None)
+        if fills is not None:
+            self.emit(channel, fills.digest())
+
+    def flush(self):
+        """Release every pending digest, e.g. before shutdown."""
+        for key, fills in list(self.pending.items()):
+            self._pop(key)
+            self.emit(key[0], fills.digest())
+
+    def __len__(self):
+        return len(self.pending)
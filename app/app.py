@@ -1,19 +1,9 @@
 import click
-import requests
 import json
 
 
 from forwarder import forwarder
-
-
-def get_bitmex_symbol(is_testnet):
-    mainnet = "https://www.bitmex.com/api/bitcoincharts"
-    testnet = "https://testnet.bitmex.com/api/bitcoincharts"
-
-    api = testnet if is_testnet else mainnet
-    r = requests.get(api)
-    data = r.json()
-    return data["all"]
+from logger import setup_logging, stop_logging
 
 
 @click.command()
@@ -25,10 +15,27 @@ def main(f):
         accounts = data["accounts"]
         if not len(accounts):
             raise Exception("not accounts found in %s" % file)
+        # records are written by a background thread, see setup_logging
+        setup_logging(**data.get("log", {}))
         testnet = data["testnet"]
-        discordwebhook = data["discordwebhook"]
-        symbol = get_bitmex_symbol(testnet)
-        forwarder(testnet, symbol, accounts, discordwebhook)
+        discordwebhook = data.get("discordwebhook")
+        shards = data.get("shards", 1)
+        record = data.get("record")
+        metrics_port = data.get("metrics_port")
+        dedup_path = data.get("dedup_path")
+        instruments_path = data.get("instruments_path")
+        sinks = data.get("sinks")
+        spool_path = data.get("spool_path")
+        digest_window = data.get("digest_window", 0)
+        routes = data.get("routes")
+        priorities = data.get("priorities")
+        try:
+            forwarder(testnet, accounts, discordwebhook, shards=shards, record=record, metrics_port=metrics_port,
+                      dedup_path=dedup_path, instruments_path=instruments_path, sinks=sinks,
+                      spool_path=spool_path, digest_window=digest_window, config_path=file,
+                      routes=routes, priorities=priorities)
+        finally:
+            stop_logging()
 
 
 if __name__ == '__main__':
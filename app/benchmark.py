@@ -0,0 +1,77 @@
+import json
+import logging
+import random
+import time
+
+import click
+
+import codec
+
+
+def synthetic_frames(n, accounts=10, subscribed_ratio=0.5):
+    frames = []
+    for i in range(n):
+        channel = "account%d" % (i % accounts)
+        table = "execution" if random.random() < subscribed_ratio else "orderBookL2"
+        payload = {
+            "table": table,
+            "action": "insert",
+            "data": [{
+                "execID": "%032x" % random.getrandbits(128),
+                "symbol": "XBTUSD",
+                "side": "Buy",
+                "price": 6500.5,
+                "orderQty": 100,
+                "execType": "Trade",
+                "ordStatus": "Filled",
+                "text": "Submission from www.bitmex.com",
+            } for _ in range(5)],
+        }
+        frames.append(json.dumps([0, channel, channel, payload], separators=(',', ':')))
+    return frames
+
+
+def legacy_decode(logger, subscribed, message):
+    # what _dispatch did before: always decode and always build the debug string
+    message = json.loads(message)
+    logger.debug("recv %s" % (json.dumps(message)))
+    _, channel, _, payload = message
+    return payload if payload["table"] in subscribed else None
+
+
+def lazy_decode(logger, subscribed, message):
+    logger.debug("recv %s", message)
+    channel, table = codec.peek(message)
+    if table is not None and table not in subscribed:
+        return None
+    _, channel, _, payload = codec.loads(message)
+    return payload
+
+
+def measure(name, decode, logger, subscribed, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        decode(logger, subscribed, frame)
+    elapsed = time.perf_counter() - start
+    rate = len(frames) / elapsed
+    click.echo("%-8s %10.0f frames/sec" % (name, rate))
+    return rate
+
+
+@click.command()
+@click.option('--frames', default=100000, help='number of synthetic frames')
+@click.option('--subscribed-ratio', default=0.5, help='ratio of frames from subscribed tables')
+def main(frames, subscribed_ratio):
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+    subscribed = {"execution"}
+    data = synthetic_frames(frames, subscribed_ratio=subscribed_ratio)
+
+    click.echo("json backend: %s" % codec.BACKEND)
+    before = measure("before", legacy_decode, logger, subscribed, data)
+    after = measure("after", lazy_decode, logger, subscribed, data)
+    click.echo("speedup  %10.2fx" % (after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import json
+import random
 import threading
 import time
 import traceback
@@ -8,14 +9,38 @@ import urllib
 import codecs
 import hashlib
 import hmac
-from collections import defaultdict
+from collections import defaultdict, deque
 
-import janus
-import requests
 import websockets
 
-
-class BitmexMultiplexingAsyncWebsocket(object):
+import codec
+import metrics
+from dispatcher import ChannelDispatcher
+from table_store import TableStore
+from orderbook import OrderBookStore
+from subscription import SubscriptionManager
+from heartbeat import Heartbeat
+
+FRAMES = metrics.REGISTRY.counter(
+    "bitmex_frames_total", "Frames received per channel and table.", ["client", "channel", "table"])
+SKIPPED = metrics.REGISTRY.counter(
+    "bitmex_frames_skipped_total", "Frames of unsubscribed tables skipped before decoding.", ["client"])
+RECONNECTS = metrics.REGISTRY.counter(
+    "bitmex_reconnects_total", "Reconnects of the websocket.", ["client"])
+CONNECTED = metrics.REGISTRY.gauge(
+    "bitmex_connected", "Whether the websocket is connected.", ["client"])
+SEND_QUEUE = metrics.REGISTRY.gauge(
+    "bitmex_send_queue_depth", "Frames waiting in the send queue.", ["client"])
+RESUBSCRIBE = metrics.REGISTRY.histogram(
+    "bitmex_resubscribe_seconds", "Time from a disconnect until every channel is subscribed again.", ["client"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+
+# every frame is logged at debug level, under a category which can be sampled
+FRAME_LOG = {"category": "frame"}
+
+
+class BitmexMultiplexingWebsocket(object):
     VERB = "GET"
     AUTH_ENDPOINT = "/realtime"
     ENDPOINT = "/realtimemd?transport=websocket&b64=1"
@@ -78,8 +103,14 @@ class BitmexMultiplexingAsyncWebsocket(object):
         'privateNotifications'
     ]
 
-    def __init__(self, testnet=False, logger=None, logger_level=logging.INFO):
+    def __init__(self, testnet=False, logger=None, logger_level=logging.INFO,
+                 handler_queue_size=1000, handler_concurrency=1, handler_overflow=ChannelDispatcher.BLOCK,
+                 message_queue_size=1000, recorder=None, endpoint=None, name=None,
+                 ping_interval=5, max_missed_pongs=3, silence_timeout=30):
         self.endpoint = self.MAINNET_ENDPOINT if testnet is False else self.TESTNET_ENDPOINT
+        if endpoint is not None:
+            self.endpoint = endpoint
+        self.name = name if name is not None else self.endpoint
         self.logger = logger if logger is not None else self._setup_logger(logger_level)
 
         self.channels = defaultdict(dict)
@@ -88,40 +119,178 @@ class BitmexMultiplexingAsyncWebsocket(object):
 
         self.closed = False
         self.connected = False
+        self.subscriptions = SubscriptionManager()
+        self.flush_scheduled = False
         self.expires = 60 * 60
         self.timeout = 2
         self.maxretry = 10
         self.tried = 0
+        # jittered exponential backoff between reconnects, the retry budget is
+        # given back once a connection stayed up for stable_after seconds
+        self.backoff_base = 0.5
+        self.backoff_max = 30
+        self.stable_after = 60
+        self.connected_at = None
+        self.disconnected_at = None
+        self.resubscribe_times = deque(maxlen=100)
+        self.resubscribe_callbacks = []
+        self.disconnect_callbacks = []
+        self.message_queue_size = message_queue_size
+        self.recorder = recorder
+        # a half-open socket is given up after missed pongs or silence
+        # instead of waiting for the TCP timeout
+        self.heartbeat = Heartbeat(self.name, interval=ping_interval, max_missed=max_missed_pongs,
+                                   silence_timeout=silence_timeout)
+        self.dead = None
+
+        # created by connect() in the loop which runs the client
+        self.task = None
+        self.queue = None
+        self.messages = None
+        self.connected_event = None
+        self.ready_event = None
+
+        self.dispatcher = ChannelDispatcher(self.logger,
+                                            name=self.name,
+                                            maxsize=handler_queue_size,
+                                            concurrency=handler_concurrency,
+                                            overflow=handler_overflow)
+        self.tables = TableStore(max_len=self.MAX_TABLE_LEN)
+        self.skipped = 0
+        self.orderbooks = OrderBookStore()
+
+        # metric children are looked up once, _dispatch only increments them
+        self.frame_counters = {}
+        self.skipped_counter = SKIPPED.labels(self.name)
+        self.reconnect_counter = RECONNECTS.labels(self.name)
+        self.connected_gauge = CONNECTED.labels(self.name)
+        self.resubscribe_histogram = RESUBSCRIBE.labels(self.name)
+        SEND_QUEUE.labels(self.name).set_function(lambda: self.queue.qsize() if self.queue is not None else 0)
+
+    def set_handler_concurrency(self, channel, concurrency):
+        self.dispatcher.set_concurrency(channel, concurrency)
+
+    def stats(self):
+        return self.dispatcher.stats()
+
+    def ping_stats(self):
+        return self.heartbeat.stats()
+
+    def get_table(self, channel, table):
+        """
+        The image of a table as of the last received frame, which may be newer
+        than the payload a handler is processing, see Table.
+        """
+        return self.tables.get(channel, table)
+
+    def get_orderbook(self, symbol):
+        return self.orderbooks.get(symbol)
+
+    def set_table_limit(self, table, max_len):
+        self.tables.set_limit(table, max_len)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self.closed:
+            await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # yields (channel, table, payload) of the topics subscribed without a handler
+        if self.messages.empty() and self.task.done():
+            raise StopAsyncIteration
+        message = await self.messages.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self):
+        self.queue = asyncio.Queue()
+        self.messages = asyncio.Queue(maxsize=self.message_queue_size)
+        self.connected_event = asyncio.Event()
+        self.ready_event = asyncio.Event()
+        self.task = asyncio.ensure_future(self._open())
+
+        try:
+            await asyncio.wait_for(self.connected_event.wait(), self.timeout * 1.2)
+        except asyncio.TimeoutError:
+            self.task.cancel()
+            raise Exception("connect %s timeoutd" % (self.endpoint))
 
-        self.loop = asyncio.get_event_loop()
-        self.queue = janus.Queue(loop=self.loop)
-
-    def get_all_symbol(self):
-        mainnet = "https://www.bitmex.com/api/bitcoincharts"
-        testnet = "https://testnet.bitmex.com/api/bitcoincharts"
-
-        api = testnet if 'testnet' in self.endpoint else mainnet
-        r = requests.get(api)
-        data = r.json()
-        return data["all"]
-
-    def wait(self):
-        self.thread.join()
+    async def wait_closed(self):
+        await self.task
 
-    def open(self):
-        self.thread = threading.Thread(target=self._open, daemon=True)
-        self.thread.start() 
+    def is_ready(self):
+        return self.connected and not self.subscriptions.pending() and not self.subscriptions.failed()
 
-        # workaround to wait websocket
-        time.sleep(self.timeout*1.2)
-        if not self.connected:
-            raise Exception("connect %s timeoutd" % (self.endpoint))
+    async def wait_ready(self, timeout=None):
+        # wait until all accounts are authenticated and all subscriptions acknowledged
+        try:
+            await asyncio.wait_for(self.ready_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.is_ready()
 
-    def close(self):
+    def _update_ready(self):
+        if self.ready_event is None:
+            return
+        failed = self.subscriptions.failed()
+        pending = self.subscriptions.pending()
+        if self.connected and self.disconnected_at is not None and not pending:
+            elapsed = asyncio.get_event_loop().time() - self.disconnected_at
+            self.disconnected_at = None
+            # a rejected account must not hold the others back
+            failed_channels = set(request[1] for request in failed)
+            accounts = [name for name, account in self.accounts.items()
+                        if account["verified"] and name not in failed_channels]
+            failed_accounts = [name for name in self.accounts if name not in accounts]
+            if failed_channels:
+                self.logger.warning("resubscribed %s in %.3fs, channels %s failed",
+                                    self.endpoint, elapsed, sorted(failed_channels))
+            else:
+                self.resubscribe_times.append(elapsed)
+                self.resubscribe_histogram.observe(elapsed)
+                self.logger.info("resubscribed all channels of %s in %.3fs", self.endpoint, elapsed)
+            for callback in self.resubscribe_callbacks:
+                asyncio.ensure_future(self._resubscribed(callback, accounts, failed_accounts))
+        if failed or (self.connected and not pending):
+            self.ready_event.set()
+        else:
+            self.ready_event.clear()
+
+    def on_disconnect(self, callback):
+        """Call callback(accounts) once the connection was lost, before reconnecting."""
+        self.disconnect_callbacks.append(callback)
+
+    def on_resubscribe(self, callback):
+        """
+        Call the coroutine function callback(accounts, failed) after every
+        reconnect, once no channel is pending any more, e.g. to recover what was
+        missed. accounts were verified and subscribed again, failed are the
+        other accounts of this client.
+        """
+        self.resubscribe_callbacks.append(callback)
+
+    async def _resubscribed(self, callback, accounts, failed):
+        try:
+            await callback(accounts, failed)
+        except Exception:
+            self.logger.error("resubscribe callback failed: %s", traceback.format_exc())
+
+    async def close(self):
+        self._shutdown()
+        await self.task
+
+    def _shutdown(self):
         if self.closed:
             raise Exception("client has closed")
-        self.queue.close()
         self.closed = True
+        self.queue.put_nowait(None)
 
     def add_account(self, name, key, secret):
         self.accounts[name] = {
@@ -130,60 +299,94 @@ class BitmexMultiplexingAsyncWebsocket(object):
             'verified': False,
         }
 
+    def remove_account(self, name):
+        # the other channels of the connection are not touched, removing an
+        # account twice is a no-op so an interrupted reload can be retried
+        self.accounts.pop(name, None)
+        if name in self.channels and self.subscriptions.has_channel(name):
+            self.close_channel(name)
+
     def _clean(self):
         # clean account state
         for _, account in self.accounts.items():
             account["verified"] = False
 
+        # frames queued for the old connection are rebuilt by _subscribe
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
         # clean connect state
         self.connected = False
-        self.closed = False
+        self.connected_event.clear()
+        self._update_ready()
 
-    def _open(self):
+    def _backoff(self):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** self.tried)))
+
+    async def _open(self):
+        loop = asyncio.get_event_loop()
         while True:
+            self.connected_at = None
             try:
-                rc = self.loop.run_until_complete(self._run()) 
+                rc = await self._run()
                 if rc:
                     self.logger.info("Exited, because of actived close")
                     break
             except Exception as e:
                 self.logger.info("Got exception: %s" % repr(e))
 
+            if self.disconnected_at is None:
+                self.disconnected_at = loop.time()
+                for callback in self.disconnect_callbacks:
+                    callback(list(self.accounts))
+            if self.connected_at is not None and loop.time() - self.connected_at >= self.stable_after:
+                self.tried = 0
+
             self.tried += 1
+            self.reconnect_counter.inc()
             if self.tried < self.maxretry:
                 self.logger.info("reconnect(%d/%d) to %s", self.tried, self.maxretry, self.endpoint)
             else:
                 self.logger.error("attempt to reconnect(%d/%d) %s failed", self.tried, self.maxretry, self.endpoint)
                 break
 
-            time.sleep(1)
+            # a dead connection is replaced right away, the endpoint itself was reachable
+            if self.dead is None:
+                await asyncio.sleep(self._backoff())
+            self.dead = None
             self._clean()
 
-        self.loop.close()
+        self.dispatcher.close()
+        if self.recorder is not None:
+            self.recorder.flush()
+        if not self.messages.full():
+            self.messages.put_nowait(None)
 
     async def _run(self):
         async with websockets.connect(self.endpoint, timeout=self.timeout) as ws:
             self.connected = True
+            self.connected_gauge.set(1)
+            self.connected_at = asyncio.get_event_loop().time()
+            self.heartbeat.reset(self.connected_at)
             self.logger.info("connected websocket: %s" % self.endpoint)
 
+            await self._subscribe(ws)
+            self.connected_event.set()
+            self._update_ready()
+
             recv_task = asyncio.ensure_future(
                 self._recv(ws))
             send_task = asyncio.ensure_future(
                 self._send(ws))
             ping_task = asyncio.ensure_future(
                 self._ping(ws))
-            subscribe_task = asyncio.ensure_future(
-                self._subscribe(ws))
             done, pending = await asyncio.wait(
-                [recv_task, send_task, ping_task, subscribe_task],
-                return_when=asyncio.FIRST_EXCEPTION,
+                [recv_task, send_task, ping_task],
+                return_when=asyncio.FIRST_COMPLETED,
             )
 
-            exit = False
             for task in done:
                 e = task.exception()
-                if isinstance(e, RuntimeError) and str(e) == "Modification of closed queue is forbidden":
-                    exit = True
                 if e:
                     self.logger.error("websocket %s exited with %s" % (self.endpoint, repr(e)))
 
@@ -193,113 +396,152 @@ class BitmexMultiplexingAsyncWebsocket(object):
             await ws.close()
 
         self.connected = False
+        self.connected_gauge.set(0)
+        self.connected_event.clear()
+        self._update_ready()
 
-        return exit
+        return self.closed
 
     async def _ping(self, ws):
+        # pings bypass the send queue, so a backlog of frames does not delay them
+        loop = asyncio.get_event_loop()
         while True:
-            await asyncio.sleep(5)
-            await self.queue.async_q.put("ping")
+            await asyncio.sleep(self.heartbeat.interval)
+            self.dead = self.heartbeat.check(loop.time())
+            if self.dead is not None:
+                self.logger.error("websocket %s is dead (%s), reconnect", self.endpoint, self.dead)
+                return
+            self.heartbeat.ping(loop.time())
+            await ws.send("ping")
 
     async def _subscribe(self, ws):
-        # resubscribe all topics
-        for channel, topics in self.channels.items():
-            for topic, d in topics.items():
-                topic = d["topic"]
-                symbol = d["symbol"]
-                keysecret = None
-                if channel in self.accounts:
-                    key = self.accounts[channel]["key"]
-                    secret = self.accounts[channel]["secret"]
-                    keysecret = (key, secret)
-                self._open_subscription(topic, symbol, channel, keysecret)
+        # resubscribe all topics, every channel is opened, authenticated and
+        # subscribed with one frame each, all of them queued at once
+        self.subscriptions.reset()
+        self._flush()
 
     async def _recv(self, ws):
+        loop = asyncio.get_event_loop()
+        heartbeat = self.heartbeat
         async for message in ws:
+            heartbeat.last_recv = loop.time()
+            if self.recorder is not None:
+                self.recorder.write(message)
             await self._dispatch(message)
 
     async def _dispatch(self, message):
         if message == "pong":
-            self.logger.debug("recev pong frame")
+            rtt = self.heartbeat.pong(asyncio.get_event_loop().time())
+            if rtt is not None:
+                self.logger.debug("recv pong frame, rtt %.3fms", rtt * 1000)
             return
 
-        message = json.loads(message)
-        self.logger.debug("recv %s" % (json.dumps(message)))
+        self.logger.debug("recv %s", message, extra=FRAME_LOG)
+
+        # skip decoding frames of the tables nobody subscribed
+        channel, table = codec.peek(message)
+        if table is not None and table not in self.channels.get(channel, ()):
+            self.skipped += 1
+            self.skipped_counter.inc()
+            return
+
+        raw, message = message, codec.loads(message)
         if len(message) != 4:
-            self.logger.error("unknow message format: %s", json.dumps(message))
+            self.logger.error("unknow message format: %s", raw)
             return
 
         t, channel, cid, payload = message
 
         if "error" in payload:
             self.logger.error("'channel:%s' got the error:%s", channel, payload["error"])
-            self.accounts[channel]["verified"] = False
+            request = payload.get("request", {})
+            if request.get("op") == "authKey":
+                self.subscriptions.ack_auth(channel, ok=False)
+            elif request.get("op") == "subscribe":
+                for arg in request.get("args", []):
+                    self.subscriptions.ack(channel, arg, ok=False)
+            if channel in self.accounts:
+                self.accounts[channel]["verified"] = False
+            self._update_ready()
             return
 
         if channel not in self.channels:
             self.logger.info("unknow channel %s" % channel)
             return
 
+        extra = {"account": channel, "category": "subscription"}
         if "subscribe" in payload:
-            self.logger.info("'channel:%s' subscribed %s" % (channel, payload["subscribe"]))
+            self.logger.info("'channel:%s' subscribed %s" % (channel, payload["subscribe"]), extra=extra)
+            self.subscriptions.ack(channel, payload["subscribe"])
+            self._update_ready()
+        elif "unsubscribe" in payload:
+            self.logger.info("'channel:%s' unsubscribed %s" % (channel, payload["unsubscribe"]), extra=extra)
         elif "info" in payload:
-            self.logger.info("'channel:%s' connected: %s" % (channel, payload["info"]))
+            self.logger.info("'channel:%s' connected: %s" % (channel, payload["info"]), extra=extra)
         elif "success" in payload:
-            self.logger.info("'channel:%s' was verified" % (channel))
-            self.accounts[channel]["verified"] = True
+            self.logger.info("'channel:%s' was verified" % (channel), extra=extra)
+            if channel in self.accounts:
+                self.accounts[channel]["verified"] = True
+            self.subscriptions.ack_auth(channel)
+            self._update_ready()
         else:
             table = payload["table"] if "table" in payload else None
-            action = payload["action"] if "action" in payload else None
 
-            if not table:
+            if not table or table not in self.channels[channel]:
                 return
 
-            # data = self._parse(channel, table, action, payload)
-            await self.channels[channel][table]["handler"](channel, table, payload)
+            self._frame_counter(channel, table).inc()
+
+            if table == OrderBookStore.TABLE:
+                self.orderbooks.apply(payload)
+            else:
+                self.tables.apply(channel, table, payload)
+            handler = self.channels[channel][table]["handler"]
+            await self.dispatcher.put(channel, table, handler, payload)
+
+    def _frame_counter(self, channel, table):
+        counters = self.frame_counters.get(channel)
+        if counters is None:
+            counters = self.frame_counters[channel] = {}
+        counter = counters.get(table)
+        if counter is None:
+            counter = counters[table] = FRAMES.labels(self.name, channel, table)
+        return counter
 
     async def _send(self, ws):
         while True:
-            message = await self.queue.async_q.get()
+            message = await self.queue.get()
             if not message:
                 break
-            self.logger.debug("send %s" % (json.dumps(message)))
-            message = json.dumps(message) if not isinstance(message, str) else message
+            message = codec.dumps(message) if not isinstance(message, str) else message
+            self.logger.debug("send %s", message)
             await ws.send(message)
 
-    # def _parse(self, channel, table, action, message):
-    #     if action == "partial":
-    #         self.logger.info("'channel:%s' %s: partial" % (channel, table))
-
-    #     elif action == "insert":
-    #         self.logger.info("'channel:%s' %s: insert %s" % (channel, table, message["data"]))
-    #         if channel not in self.data:
-    #             self.data[channel] = {}
-    #         if table not in self.data[channel]:
-    #             self.data[channel][table] = []
-
-    #         self.data[channel][table] +=  message
-
-    #         if len(self.data[channel][table]) > self.MAX_TABLE_LEN:
-    #             self.data[channel][table] = self.data[channel][table][int(self.MAX_TABLE_LEN/2):]
+    async def _push_message(self, channel, table, payload):
+        await self.messages.put((channel, table, payload))
 
-    #     elif action == "delete":
-    #         self.logger.info("'channel:%s' %s: delete %s" % (channel, table, message["data"]))
-
-    #     # update
-    #     else:
-    #         self.logger.info("'channel:%s' %s: update %s" % (channel, table, message["data"]))
+    async def subscribe(self, topic, symbol=None, account=None, handler=None):
+        # without a handler the messages are delivered by iterating the client
+        if handler is None:
+            handler = self._push_message
+        if account is None:
+            self.subscribe_public_topic(topic, symbol=symbol, handler=handler)
+        else:
+            self.subscribe_private_topic(account, topic, symbol=symbol, handler=handler)
 
     def subscribe_public_topic(self, topic, symbol=None, handler=None):
         if not self.connected:
             raise Exception("websocket was disconnected")
 
-        self.channels['public'][topic] = {
+        self.channels[self.public_account][topic] = {
             'topic': topic,
             'symbol': symbol,
             'handler': handler,
         }
 
-        self._open_subscription(topic, symbol, self.public_account)
+        self.subscriptions.add(self.public_account, subscription_name(topic, symbol))
+        self._schedule_flush()
+        self._update_ready()
 
     def subscribe_private_topic(self, account, topic, symbol=None, handler=None):
         if not self.connected:
@@ -314,31 +556,65 @@ class BitmexMultiplexingAsyncWebsocket(object):
             'handler': handler,
         }
 
-        keysecret = (self.accounts[account]['key'], self.accounts[account]['secret'])
+        self.subscriptions.add(account, subscription_name(topic, symbol), private=True)
+        self._schedule_flush()
+        self._update_ready()
 
-        self._open_subscription(topic, symbol, account, keysecret=keysecret)
+    def unsubscribe_public_topic(self, topic, symbol=None):
+        self._unsubscribe(self.public_account, topic, symbol)
 
-    def _open_subscription(self, topic, symbol, channel, keysecret=None):
+    def unsubscribe_private_topic(self, account, topic, symbol=None):
+        self._unsubscribe(account, topic, symbol)
 
-        # open channel
-        req = [self.SUBSCRIBE_TYPE, channel, channel]
-        self.queue.sync_q.put(req)
+    def _unsubscribe(self, channel, topic, symbol):
+        if not self.subscriptions.remove(channel, subscription_name(topic, symbol)):
+            raise Exception("'channel:%s' did not subscribe %s" % (channel, subscription_name(topic, symbol)))
 
-        if keysecret and not self.accounts[channel]["verified"]:
-            key, secret = keysecret
-            expires = int(round(time.time()) + self.expires) * 1000 * 1000
-            signature = bitmex_signature(secret, self.VERB, self.AUTH_ENDPOINT, expires)
-            req = [self.MESSAGE_TYPE, channel, channel, {'op': 'authKey', 'args': [key, expires, signature]}]
-            self.queue.sync_q.put(req)
+        # the handler is shared by every symbol of the topic
+        subscribed = [name for name in self.subscriptions.names(channel)
+                      if name == topic or name.startswith(topic + ":")]
+        if not subscribed:
+            self.channels[channel].pop(topic, None)
 
-            # assume it's verified
-            self.accounts[channel]["verified"] = True
+        self._schedule_flush()
+        self._update_ready()
 
+    def close_channel(self, channel):
+        if not self.subscriptions.drop(channel):
+            raise Exception("channel %s was not opened" % channel)
 
-        subscription = [topic if not symbol else topic + ":" + symbol]
-        payload = {"op": "subscribe", "args": subscription}
-        req = [self.MESSAGE_TYPE, channel, channel, payload]
-        self.queue.sync_q.put(req)
+        self.channels.pop(channel, None)
+        self.tables.drop(channel)
+        self.dispatcher.drop(channel)
+        for table in self.frame_counters.pop(channel, {}):
+            FRAMES.remove(self.name, channel, table)
+        if channel in self.accounts:
+            self.accounts[channel]["verified"] = False
+
+        if self.connected:
+            self.queue.put_nowait([self.UNSUBSCRIBE_TYPE, channel, channel])
+        self._update_ready()
+
+    def _schedule_flush(self):
+        # coalesce the subscriptions made in the same loop iteration
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_scheduled = False
+        for op, channel, args in self.subscriptions.flush():
+            if op == "open":
+                req = [self.SUBSCRIBE_TYPE, channel, channel]
+            elif op == "authKey":
+                account = self.accounts[channel]
+                expires = int(round(time.time()) + self.expires) * 1000 * 1000
+                signature = bitmex_signature(account["secret"], self.VERB, self.AUTH_ENDPOINT, expires)
+                req = [self.MESSAGE_TYPE, channel, channel, {'op': 'authKey', 'args': [account["key"], expires, signature]}]
+            else:
+                req = [self.MESSAGE_TYPE, channel, channel, {'op': op, 'args': args}]
+            self.queue.put_nowait(req)
+        self._update_ready()
 
     def _setup_logger(self, level):
         logger = logging.getLogger(self.__class__.__name__)
@@ -351,6 +627,90 @@ class BitmexMultiplexingAsyncWebsocket(object):
         return logger
 
 
+class BitmexMultiplexingAsyncWebsocket(object):
+    """
+    Threaded compatibility layer over BitmexMultiplexingWebsocket.
+
+    The client runs on its own loop in a daemon thread and the blocking calls
+    below are handed over to that loop, everything else is read from the client.
+    """
+
+    def __init__(self, testnet=False, logger=None, logger_level=logging.INFO, loop=None, **options):
+        self.client = BitmexMultiplexingWebsocket(testnet=testnet, logger=logger, logger_level=logger_level, **options)
+        self.loop = loop if loop is not None else asyncio.new_event_loop()
+        self.thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _call(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def _invoke(self, fn, *args):
+        async def invoke():
+            return fn(*args)
+        return self._call(invoke())
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def open(self):
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+
+        try:
+            self._call(self.client.connect())
+        except Exception:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            raise
+
+        # stop the loop once the client gave up reconnecting or was closed
+        self.loop.call_soon_threadsafe(
+            self.client.task.add_done_callback, lambda _: self.loop.stop())
+
+    def wait(self):
+        self.thread.join()
+
+    def close(self):
+        if self.closed:
+            raise Exception("client has closed")
+        self.loop.call_soon_threadsafe(self.client._shutdown)
+
+    def wait_ready(self, timeout=None):
+        return self._call(self.client.wait_ready(timeout))
+
+    def subscribe_public_topic(self, topic, symbol=None, handler=None):
+        self._call(self.client.subscribe(topic, symbol=symbol, handler=handler))
+
+    def subscribe_private_topic(self, account, topic, symbol=None, handler=None):
+        self._call(self.client.subscribe(topic, symbol=symbol, account=account, handler=handler))
+
+    def unsubscribe_public_topic(self, topic, symbol=None):
+        self._invoke(self.client.unsubscribe_public_topic, topic, symbol)
+
+    def unsubscribe_private_topic(self, account, topic, symbol=None):
+        self._invoke(self.client.unsubscribe_private_topic, account, topic, symbol)
+
+    def close_channel(self, channel):
+        self._invoke(self.client.close_channel, channel)
+
+    def add_account(self, name, key, secret):
+        # accounts are added from the loop once it runs
+        if self.thread is None:
+            self.client.add_account(name, key, secret)
+        else:
+            self._invoke(self.client.add_account, name, key, secret)
+
+    def remove_account(self, name):
+        self._invoke(self.client.remove_account, name)
+
+
+def subscription_name(topic, symbol=None):
+    return topic if not symbol else topic + ":" + symbol
+
+
 def bitmex_signature(secret, verb, url, nonce, postdict=None):
     """Given an API Secret and data, create a BitMEX-compatible signature."""
     data = ''
@@ -404,7 +764,6 @@ if __name__ == "__main__":
     secret1 = "ZlVal2lr4Egc245xoPDCnLzFvuW4xDWQanunnv6s-1_whbUP"
 
     bm = BitmexMultiplexingAsyncWebsocket(testnet=True, logger_level=logging.INFO)
-    print(bm.get_all_symbol())
     bm.add_account('testaccount0', key, secret)
     bm.add_account('testaccount1', key1, secret1)
     bm.open()
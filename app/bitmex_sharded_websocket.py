@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import time
+import zlib
+
+from bitmex_multiplexing_async_websocket import BitmexMultiplexingAsyncWebsocket
+
+
+class BitmexShardedWebsocket(object):
+    """
+    Spread accounts over several realtimemd connections.
+
+    An account always lands on the same shard (crc32 of its name), public
+    topics go to shard 0. Every shard is a BitmexMultiplexingAsyncWebsocket with
+    its own loop and thread, so it reconnects independently of the others.
+
+    With processes=True every shard runs in its own worker process instead; the
+    handlers then execute inside the worker, so they have to be picklable
+    (module level coroutine functions).
+    """
+    PUBLIC_SHARD = 0
+
+    def __init__(self, testnet=False, shards=2, processes=False, logger=None, logger_level=logging.INFO, **options):
+        if shards < 1:
+            raise ValueError("shards should be greater than 0")
+
+        self.testnet = testnet
+        self.shards = shards
+        self.processes = processes
+        self.logger = logger
+        self.logger_level = logger_level
+        self.options = options
+
+        self.accounts = {}
+        self.clients = {}
+        self.workers = {}
+        self.resubscribe_callbacks = []
+        self.disconnect_callbacks = []
+
+    def shard_of(self, account):
+        return zlib.crc32(account.encode()) % self.shards
+
+    def _active_shards(self):
+        shards = set(self.shard_of(name) for name in self.accounts)
+        shards.add(self.PUBLIC_SHARD)
+        return sorted(shards)
+
+    def add_account(self, name, key, secret):
+        self.accounts[name] = {
+            'key': key,
+            'secret': secret,
+        }
+        if not self.clients and not self.workers:
+            return
+
+        # added to a running shard, or a shard of its own is started
+        shard = self.shard_of(name)
+        if shard in self.clients:
+            self.clients[shard].add_account(name, key, secret)
+        elif shard in self.workers:
+            self.workers[shard].add_account(name, key, secret)
+        else:
+            self._open_shard(shard, {name: self.accounts[name]})
+
+    def remove_account(self, name):
+        if self.accounts.pop(name, None) is None:
+            return
+        self._client(self.shard_of(name)).remove_account(name)
+
+    def _open_shard(self, shard, accounts):
+        if self.processes:
+            self.workers[shard] = _ShardProcess(self.testnet, accounts, self.logger_level, self.options)
+            self.workers[shard].start()
+            return
+
+        client = BitmexMultiplexingAsyncWebsocket(testnet=self.testnet,
+                                                 logger=self.logger,
+                                                 logger_level=self.logger_level,
+                                                 loop=asyncio.new_event_loop(),
+                                                 name="shard%d" % shard,
+                                                 **self.options)
+        for name, account in accounts.items():
+            client.add_account(name, account['key'], account['secret'])
+        for callback in self.resubscribe_callbacks:
+            client.on_resubscribe(callback)
+        for callback in self.disconnect_callbacks:
+            client.on_disconnect(callback)
+        self.clients[shard] = client
+        client.open()
+
+    def open(self):
+        for shard in self._active_shards():
+            accounts = dict((name, account) for name, account in self.accounts.items()
+                            if self.shard_of(name) == shard)
+            self._open_shard(shard, accounts)
+
+    def on_resubscribe(self, callback):
+        # called in the loop of the shard which reconnected, thread shards only
+        self.resubscribe_callbacks.append(callback)
+        for client in self.clients.values():
+            client.on_resubscribe(callback)
+
+    def on_disconnect(self, callback):
+        self.disconnect_callbacks.append(callback)
+        for client in self.clients.values():
+            client.on_disconnect(callback)
+
+    def is_ready(self):
+        return all(client.is_ready() for client in self.clients.values())
+
+    def wait_ready(self, timeout=None):
+        # worker processes own their clients, only thread shards can be awaited
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for client in self.clients.values():
+            remaining = max(0, deadline - time.monotonic()) if deadline is not None else None
+            if not client.wait_ready(remaining):
+                return False
+        return True
+
+    def wait(self):
+        for client in self.clients.values():
+            client.wait()
+        for worker in self.workers.values():
+            worker.join()
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        for worker in self.workers.values():
+            worker.close()
+
+    def stats(self):
+        return dict((shard, client.stats()) for shard, client in self.clients.items())
+
+    def _client(self, shard):
+        if shard in self.clients:
+            return self.clients[shard]
+        if shard in self.workers:
+            return self.workers[shard]
+        raise Exception("websocket was disconnected")
+
+    def subscribe_public_topic(self, topic, symbol=None, handler=None):
+        self._client(self.PUBLIC_SHARD).subscribe_public_topic(topic, symbol=symbol, handler=handler)
+
+    def subscribe_private_topic(self, account, topic, symbol=None, handler=None):
+        if account not in self.accounts:
+            raise Exception("account do not found")
+
+        self._client(self.shard_of(account)).subscribe_private_topic(account, topic, symbol=symbol, handler=handler)
+
+    def unsubscribe_public_topic(self, topic, symbol=None):
+        self._client(self.PUBLIC_SHARD).unsubscribe_public_topic(topic, symbol=symbol)
+
+    def unsubscribe_private_topic(self, account, topic, symbol=None):
+        self._client(self.shard_of(account)).unsubscribe_private_topic(account, topic, symbol=symbol)
+
+
+class _ShardProcess(object):
+    def __init__(self, testnet, accounts, logger_level, options):
+        self.commands = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_run_shard,
+                                               args=(testnet, accounts, logger_level, options, self.commands),
+                                               daemon=True)
+
+    def start(self):
+        self.process.start()
+
+    def join(self):
+        self.process.join()
+
+    def close(self):
+        self.commands.put(("close",))
+
+    def subscribe_public_topic(self, topic, symbol=None, handler=None):
+        self.commands.put(("public", topic, symbol, handler))
+
+    def subscribe_private_topic(self, account, topic, symbol=None, handler=None):
+        self.commands.put(("private", account, topic, symbol, handler))
+
+    def unsubscribe_public_topic(self, topic, symbol=None):
+        self.commands.put(("unsubscribe_public", topic, symbol))
+
+    def unsubscribe_private_topic(self, account, topic, symbol=None):
+        self.commands.put(("unsubscribe_private", account, topic, symbol))
+
+    def add_account(self, name, key, secret):
+        self.commands.put(("add_account", name, key, secret))
+
+    def remove_account(self, name):
+        self.commands.put(("remove_account", name))
+
+
+def _run_shard(testnet, accounts, logger_level, options, commands):
+    client = BitmexMultiplexingAsyncWebsocket(testnet=testnet,
+                                             logger_level=logger_level,
+                                             loop=asyncio.new_event_loop(),
+                                             **options)
+    for name, account in accounts.items():
+        client.add_account(name, account['key'], account['secret'])
+    client.open()
+
+    while client.thread.is_alive():
+        try:
+            command = commands.get(timeout=1)
+        except queue.Empty:
+            continue
+
+        if command[0] == "close":
+            client.close()
+            break
+        elif command[0] == "public":
+            _, topic, symbol, handler = command
+            client.subscribe_public_topic(topic, symbol=symbol, handler=handler)
+        elif command[0] == "private":
+            _, account, topic, symbol, handler = command
+            client.subscribe_private_topic(account, topic, symbol=symbol, handler=handler)
+        elif command[0] == "unsubscribe_public":
+            _, topic, symbol = command
+            client.unsubscribe_public_topic(topic, symbol=symbol)
+        elif command[0] == "unsubscribe_private":
+            _, account, topic, symbol = command
+            client.unsubscribe_private_topic(account, topic, symbol=symbol)
+        elif command[0] == "add_account":
+            _, name, key, secret = command
+            client.add_account(name, key, secret)
+        elif command[0] == "remove_account":
+            _, name = command
+            client.remove_account(name)
+
+    client.wait()
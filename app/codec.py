@@ -0,0 +1,42 @@
+import json
+import re
+
+# pick the fastest json backend installed, json from the stdlib is the fallback
+try:
+    import orjson
+
+    BACKEND = "orjson"
+
+    def loads(s):
+        return orjson.loads(s)
+
+    def dumps(o):
+        return orjson.dumps(o).decode("utf-8")
+except ImportError:
+    try:
+        import ujson
+
+        BACKEND = "ujson"
+
+        def loads(s):
+            return ujson.loads(s)
+
+        def dumps(o):
+            return ujson.dumps(o, ensure_ascii=False)
+    except ImportError:
+        BACKEND = "json"
+        loads = json.loads
+        _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        dumps = _encoder.encode
+
+
+# realtimemd frames look like [0,"channel","channel",{"table":"trade",...
+_HEADER = re.compile(r'\[\s*\d+\s*,\s*"([^"]*)"\s*,\s*"[^"]*"\s*,\s*\{\s*"table"\s*:\s*"([^"]*)"')
+
+
+def peek(message):
+    """Return (channel, table) of a data frame without decoding it, (None, None) if unknown."""
+    m = _HEADER.match(message)
+    if m is None:
+        return None, None
+    return m.group(1), m.group(2)
@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ExecutionDeduplicator(object):
+    """
+    Bounded LRU/TTL memory of the executions already forwarded.
+
+    Keys are (account, execID). Lookups are O(1), the oldest keys are evicted
+    once maxsize is reached or ttl expired. With a path every new key is also
+    appended to that file and loaded back on start, so a restart does not
+    forward the rows BitMEX replays on subscribe again. The file is compacted
+    to the remembered keys on start and whenever it holds twice maxsize lines.
+    """
+
+    def __init__(self, maxsize=100000, ttl=24 * 60 * 60, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.seen = OrderedDict()
+        self.file = None
+        self.lines = 0
+        # shards call in from their own threads
+        self.lock = threading.Lock()
+
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        if os.path.exists(self.path):
+            now = time.time()
+            with open(self.path) as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) != 3:
+                        continue
+                    account, exec_id, ts = parts
+                    if now - float(ts) < self.ttl:
+                        self._remember((account, exec_id), float(ts))
+        self._compact()
+
+    def _compact(self):
+        # rewrite the file with only the keys still remembered
+        if self.file is not None:
+            self.file.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for (account, exec_id), ts in self.seen.items():
+                f.write("%s\t%s\t%f\n" % (account, exec_id, ts))
+        os.replace(tmp, self.path)
+        self.file = open(self.path, "a")
+        self.lines = len(self.seen)
+
+    def _remember(self, key, ts):
+        self.seen[key] = ts
+        self.seen.move_to_end(key)
+        while len(self.seen) > self.maxsize:
+            self.seen.popitem(last=False)
+
+    def _expire(self, now):
+        while self.seen:
+            key, ts = next(iter(self.seen.items()))
+            if now - ts < self.ttl:
+                break
+            self.seen.popitem(last=False)
+
+    def check(self, account, exec_id):
+        """Return True if the execution was already forwarded, remember it otherwise."""
+        now = time.time()
+        key = (account, exec_id)
+        with self.lock:
+            self._expire(now)
+            if key in self.seen:
+                return True
+
+            self._remember(key, now)
+            if self.file is not None:
+                self.file.write("%s\t%s\t%f\n" % (account, exec_id, now))
+                self.lines += 1
+                if self.lines > 2 * self.maxsize:
+                    self._compact()
+        return False
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __len__(self):
+        return len(self.seen)
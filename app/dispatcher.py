@@ -0,0 +1,154 @@
+import asyncio
+import time
+import traceback
+import zlib
+from collections import defaultdict
+
+import metrics
+
+HANDLER_LATENCY = metrics.REGISTRY.histogram(
+    "bitmex_handler_seconds", "Time spent in the handler per channel and table.", ["client", "channel", "table"])
+HANDLER_QUEUE = metrics.REGISTRY.gauge(
+    "bitmex_handler_queue_depth", "Frames waiting for the handlers per channel.", ["client", "channel"])
+DROPPED = metrics.REGISTRY.counter(
+    "bitmex_handler_dropped_total", "Frames dropped by the overflow policy per channel.", ["client", "channel"])
+
+
+class ChannelDispatcher(object):
+    """
+    Run handlers off the receive loop.
+
+    Every channel gets its own lanes (one per worker) of bounded queues. A table
+    is always routed to the same lane, so frames of one table are handled in
+    order; with the default concurrency of 1 the whole channel stays in order.
+    """
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+
+    OVERFLOW_POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+    def __init__(self, logger, maxsize=1000, concurrency=1, overflow=BLOCK, name="default"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("unknow overflow policy %s" % overflow)
+        if concurrency < 1:
+            raise ValueError("concurrency should be greater than 0")
+
+        self.logger = logger
+        self.name = name
+        self.maxsize = maxsize
+        self.default_concurrency = concurrency
+        self.overflow = overflow
+
+        self.concurrency = {}
+        self.lanes = {}
+        self.workers = {}
+        self.dropped = {}
+        self.counters = defaultdict(lambda: {
+            'queued': 0,
+            'processed': 0,
+            'dropped': 0,
+            'errors': 0,
+            'max_depth': 0,
+        })
+
+    def set_concurrency(self, channel, concurrency):
+        if concurrency < 1:
+            raise ValueError("concurrency should be greater than 0")
+        if channel in self.lanes:
+            raise Exception("'channel:%s' workers were already started" % channel)
+        self.concurrency[channel] = concurrency
+
+    def _get_lanes(self, channel):
+        lanes = self.lanes.get(channel)
+        if lanes is None:
+            n = self.concurrency.get(channel, self.default_concurrency)
+            lanes = [asyncio.Queue(maxsize=self.maxsize) for _ in range(n)]
+            self.lanes[channel] = lanes
+            self.dropped[channel] = DROPPED.labels(self.name, channel)
+            HANDLER_QUEUE.labels(self.name, channel).set_function(lambda: sum(q.qsize() for q in lanes))
+            self.workers[channel] = [
+                asyncio.ensure_future(self._work(channel, queue)) for queue in lanes
+            ]
+        return lanes
+
+    async def put(self, channel, table, handler, payload):
+        lanes = self._get_lanes(channel)
+        queue = lanes[zlib.crc32(table.encode()) % len(lanes)] if len(lanes) > 1 else lanes[0]
+        counter = self.counters[channel]
+        item = (table, handler, payload)
+
+        if self.overflow == self.BLOCK:
+            await queue.put(item)
+        elif queue.full():
+            counter['dropped'] += 1
+            self.dropped[channel].inc()
+            if self.overflow == self.DROP_NEWEST:
+                self.logger.warning("'channel:%s' handler queue is full, drop %s frame", channel, table)
+                return
+            queue.get_nowait()
+            queue.task_done()
+            self.logger.warning("'channel:%s' handler queue is full, drop the oldest frame", channel)
+            queue.put_nowait(item)
+        else:
+            queue.put_nowait(item)
+
+        counter['queued'] += 1
+        depth = queue.qsize()
+        if depth > counter['max_depth']:
+            counter['max_depth'] = depth
+
+    async def _work(self, channel, queue):
+        counter = self.counters[channel]
+        latencies = {}
+        while True:
+            table, handler, payload = await queue.get()
+            latency = latencies.get(table)
+            if latency is None:
+                latency = latencies[table] = HANDLER_LATENCY.labels(self.name, channel, table)
+            start = time.perf_counter()
+            try:
+                await handler(channel, table, payload)
+                latency.observe(time.perf_counter() - start)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                counter['errors'] += 1
+                self.logger.error("'channel:%s' %s handler failed: %s", channel, table, traceback.format_exc())
+            finally:
+                counter['processed'] += 1
+                queue.task_done()
+
+    def stats(self):
+        stats = {}
+        for channel, counter in self.counters.items():
+            stat = dict(counter)
+            stat['depth'] = sum(queue.qsize() for queue in self.lanes.get(channel, []))
+            stats[channel] = stat
+        return stats
+
+    def drop(self, channel):
+        """Cancel the workers of a closed channel, its queued frames and metrics go with them."""
+        for worker in self.workers.pop(channel, []):
+            worker.cancel()
+        self.lanes.pop(channel, None)
+        self.dropped.pop(channel, None)
+        self.counters.pop(channel, None)
+        self.concurrency.pop(channel, None)
+        HANDLER_QUEUE.remove(self.name, channel)
+        DROPPED.remove(self.name, channel)
+        for values in list(HANDLER_LATENCY.children):
+            if values[:2] == (self.name, channel):
+                HANDLER_LATENCY.remove(*values)
+
+    async def join(self):
+        for lanes in list(self.lanes.values()):
+            for queue in lanes:
+                await queue.join()
+
+    def close(self):
+        for workers in self.workers.values():
+            for worker in workers:
+                worker.cancel()
+        self.workers = {}
+        self.lanes = {}
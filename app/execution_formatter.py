@@ -0,0 +1,103 @@
+def _field(name):
+    def get(o, instrument):
+        return o.get(name)
+    return get
+
+
+def _satoshi(name):
+    def get(o, instrument):
+        return (o.get(name) or 0) / 100000000
+    return get
+
+
+def _price(name):
+    # as many decimals as the tick size of the instrument needs
+    def get(o, instrument):
+        decimals = instrument.decimals if instrument is not None else 8
+        return "%.*f" % (decimals, o.get(name) or 0)
+    return get
+
+
+def _direction(o, instrument):
+    return "above" if o.get("side") == "Buy" else "below"
+
+
+class Template(object):
+    """A title and a body format with the getters of the only fields they need."""
+
+    def __init__(self, title, title_fields, body, body_fields):
+        self.title = title
+        self.body = body
+        self.title_getters = [f if callable(f) else _field(f) for f in title_fields]
+        self.body_getters = [f if callable(f) else _field(f) for f in body_fields]
+
+    def render(self, channel, o, instrument=None):
+        title = self.title % tuple(get(o, instrument) for get in self.title_getters)
+        body = self.body % tuple(get(o, instrument) for get in self.body_getters)
+        return title, "%s: %s" % (channel, body)
+
+
+STOP_BODY = ("%s %d Contracts of %s at Market. Trigger: Last Price @%s and %s. %s",
+             ("side", "orderQty", "symbol", _price("stopPx"), _direction, "text"))
+LIMIT_BODY = ("%s %d Contracts of %s at %s. %s",
+              ("side", "orderQty", "symbol", _price("price"), "text"))
+
+# (execType, variant) -> template, the variant is picked by VARIANTS
+TEMPLATES = {
+    ("New", "Stop"): Template("%s Order Submitted", ("ordType",), *STOP_BODY),
+    ("New", None): Template("%s Order Submitted", ("ordType",), *LIMIT_BODY),
+    ("Restated", None): Template("%s Order Restated", ("ordType",), *LIMIT_BODY),
+    ("TriggeredOrActivatedBySystem", None): Template(
+        "Stop Triggered", (),
+        "A stop to %s %d contracts of %s at %s has been triggered. %s",
+        ("side", "orderQty", "symbol", _price("price"), "text")),
+    ("Trade", "Filled"): Template(
+        "%s Order Filled", ("ordType",),
+        "%d Contracts of %s %s at %s. The order has fully filled. %s",
+        ("orderQty", "symbol", "side", _price("price"), "text")),
+    ("Trade", "PartiallyFilled"): Template(
+        "%d Contracts %s", ("lastQty", "side"),
+        "%d Contracts of %s %s at %s. %d contracts remain in the order. %s",
+        ("lastQty", "symbol", "side", _price("price"), "leavesQty", "text")),
+    # digests of the fills coalesced by the aggregator
+    ("Trade", "FilledDigest"): Template(
+        "%s Order Filled", ("ordType",),
+        "%d Contracts of %s %s, the last %d at an average of %s in %d fills. The order has fully filled. %s",
+        ("orderQty", "symbol", "side", "digestQty", _price("digestAvgPx"), "fills", "text")),
+    ("Trade", "PartiallyFilledDigest"): Template(
+        "%d Contracts %s in %d Fills", ("digestQty", "side", "fills"),
+        "%d Contracts of %s %s at an average of %s in %d fills. %d contracts remain in the order. %s",
+        ("digestQty", "symbol", "side", _price("digestAvgPx"), "fills", "leavesQty", "text")),
+    ("Canceled", "Stop"): Template(
+        "%s Order Canceled", ("ordType",),
+        "%s %d Contract of %s at Market. Trigger: Last Price @%s and %s. %s",
+        STOP_BODY[1]),
+    ("Canceled", None): Template(
+        "%s Order Canceled", ("ordType",),
+        "%s %d Contract of %s at %s. %s",
+        LIMIT_BODY[1]),
+    ("Rejected", None): Template("%s Order Rejected", ("ordType",), "%s", ("text",)),
+    ("Funding", None): Template("%s Funding Order", ("symbol",), "Paid %.8f %s", (_satoshi("execComm"), "symbol")),
+}
+
+VARIANTS = {
+    "New": lambda o: "Stop" if o.get("ordType") == "Stop" else None,
+    "Canceled": lambda o: "Stop" if o.get("ordType") == "Stop" else None,
+    "Trade": lambda o: "%sDigest" % o.get("ordStatus") if "fills" in o else o.get("ordStatus"),
+}
+
+
+def render(channel, o, instruments=None):
+    """
+    Return (title, content) of an execution, None if there is no template for it.
+
+    Prices are shown with the precision of the symbol when an instrument
+    catalogue is given.
+    """
+    exec_type = o.get("execType")
+    variant = VARIANTS[exec_type](o) if exec_type in VARIANTS else None
+    template = TEMPLATES.get((exec_type, variant))
+    if template is None:
+        return None
+    instrument = instruments.get(o.get("symbol")) if instruments is not None else None
+    return template.render(channel, o, instrument)
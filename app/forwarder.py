@@ -1,205 +1,230 @@
-import json
-
 from bitmex_async_websocket import BitMEXAsyncWebsocket
-from notifier import discord
+import execution_formatter
+import metrics
 from logger import logger
+from recorder import FrameRecorder
+from dedup import ExecutionDeduplicator
+from aggregator import FillAggregator
+from recovery import ExecutionRecovery
+from instruments import InstrumentCatalogue
+from sinks import DiscordSink, SinkPipeline, build_sinks
+from spool import Spool
+from reloader import ConfigWatcher, diff_accounts
+from routing import Router
+from scheduler import Priorities
 from bitmex_multiplexing_async_websocket import BitmexMultiplexingAsyncWebsocket
+from bitmex_sharded_websocket import BitmexShardedWebsocket
 
+EXECUTIONS = metrics.REGISTRY.counter(
+    "forwarder_executions_total", "Executions received per execType.", ["exec_type"])
+DUPLICATES = metrics.REGISTRY.counter(
+    "forwarder_duplicate_executions_total", "Executions dropped because they were already forwarded.")
 
-async def process_new_order(channel, o, log):
-    symbol = o["symbol"]
-    price = o["price"]
-    side = o["side"]
-    order_qty = o["orderQty"]
-    order_type = o["ordType"]
-    simple_leaves_qty = o["simpleLeavesQty"]
-    text = o["text"]
-    ex_destination = o["exDestination"]
-    stop_price = o["stopPx"]
-
-    title = "%s Order Submitted" % (order_type)
-    if order_type == "Stop":
-        direction = "above" if side == "Buy" else "below"
-        content = "%s %d Contracts of %s at Market. Trigger: Last Price @%f and %s. %s" % (side, order_qty, symbol, stop_price, direction, text)
-    else:
-        content = "%s %d Contracts of %s at %.8f. %s" % (side, order_qty, symbol, price, text)
-
-    content = "%s: %s" % (channel, content)
-
-    await log(title, content)
-
-
-async def process_restated_order(channel, o, log):
-    symbol = o["symbol"]
-    price = o["price"]
-    side = o["side"]
-    order_qty = o["orderQty"]
-    order_type = o["ordType"]
-    simple_leaves_qty = o["simpleLeavesQty"]
-    text = o["text"]
-    ex_destination = o["exDestination"]
-
-    title = "%s Order Restated" % (order_type)
-    content = "%s %d Contracts of %s at %.8f. %s" % (side, order_qty, symbol, price, text)
-    content = "%s: %s" % (channel, content)
-
-    await log(title, content)
-
-
-async def process_trigger_order(channel, o, log):
-    symbol = o["symbol"]
-    price = o["price"]
-    side = o["side"]
-    order_qty = o["orderQty"]
-    order_type = o["ordType"]
-    simple_leaves_qty = o["simpleLeavesQty"]
-    text = o["text"]
-    ex_destination = o["exDestination"]
-
-    title = "Stop Triggered"
-    content = "A stop to %s %d contracts of %s at %.8f has been triggered. %s" % (side, order_qty, symbol, price, text)
-    content = "%s: %s" % (channel, content)
-
-    await log(title, content)
-
-
-async def process_trade_order(channel, o, log):
-    symbol = o["symbol"]
-    price = o["price"]
-    side = o["side"]
-    ex_destination = o["exDestination"]
-    order_qty = o["orderQty"]
-    order_type = o["ordType"]
-    order_status = o["ordStatus"]
-    last_qty = o["lastQty"]
-    leaves_qty = o["leavesQty"]
-    text = o["text"]
-
-    if order_status == "Filled":
-        title = "%s Order Filled" % (order_type) 
-        body = "%d Contracts of %s %s at %.8f. The order has fully filled. %s" % (order_qty, symbol, side, price, text)
-    elif order_status == "PartiallyFilled":
-        title = "%d Contracts %s" % (last_qty, side)
-        body = "%d Contracts of %s %s at %.8f. %d contracts remain in the order. %s" % (last_qty, symbol, side, price, leaves_qty, text)
-
-    content = body
-    content = "%s: %s" % (channel, content)
-
-    await log(title, content)
-
-
-async def process_cancel_order(channel, o, log):
-    symbol = o["symbol"]
-    price = o["price"]
-    side = o["side"]
-    ex_destination = o["exDestination"]
-    order_qty = o["orderQty"]
-    order_type = o["ordType"]
-    order_status = o["ordStatus"]
-    last_qty = o["lastQty"]
-    leaves_qty = o["leavesQty"]    
-    text = o['text']
-    stop_price = o["stopPx"]
-
-    title = "%s Order Canceled" % (order_type)
-    if order_type == "Stop":
-        direction = "above" if side == "Buy" else "below"
-        content = "%s %d Contract of %s at Market. Trigger: Last Price @%f and %s. %s" %(side, order_qty, symbol, stop_price, direction, text)
-    else:
-        content = "%s %d Contract of %s at %.8f. %s" %(side, order_qty, symbol, price, text)
-
-    content = "%s: %s" % (channel, content)
-
-    await log(title, content)
-
-async def process_rejected_order(channel, o, log):
-    symbol = o["symbol"]
-    price = o["price"]
-    side = o["side"]
-    ex_destination = o["exDestination"]
-    order_qty = o["orderQty"]
-    order_type = o["ordType"]
-    order_status = o["ordStatus"]
-    last_qty = o["lastQty"]
-    leaves_qty = o["leavesQty"]    
-    text = o['text']
-    stop_price = o["stopPx"]
-
-    title = "%s Order Rejected" % (order_type)
-    content = text
-
-    content = "%s: %s" % (channel, content)
 
-    await log(title, content)
+def forwarder(testnet, accounts, discordwebhook=None, shards=1, record=None, endpoint=None, metrics_port=None,
+              dedup_path=None, instruments_path=None, rest_endpoint=None, sinks=None, spool_path=None,
+              digest_window=0, config_path=None, routes=None, priorities=None):
+    if metrics_port:
+        metrics.MetricsServer(port=metrics_port).start()
 
+    # the cached catalogue is used right away and refreshed in the background
+    instruments = InstrumentCatalogue(testnet=testnet, path=instruments_path, endpoint=rest_endpoint, logger=logger)
+    instruments.start()
 
-async def process_funding_order(channel, o, log):
-    symbol = o["symbol"]
-    price = o["price"]
-    side = o["side"]
-    ex_destination = o["exDestination"]
-    order_qty = o["orderQty"]
-    order_type = o["ordType"]
-    order_status = o["ordStatus"]
-    last_qty = o["lastQty"]
-    leaves_qty = o["leavesQty"]    
-    text = o['text']
-    stop_price = o["stopPx"]
-    exec_comm = o["execComm"] / 100000000
-
-    title = "%s Funding Order" % (symbol)
-    content = "Paid %.8f %s" %(exec_comm, symbol)
-
-    content = "%s: %s" % (channel, content)
-
-    await log(title, content)
-    
-
-def forwarder(testnet, symbols, accounts, discordwebhook):
-    async def log(title, content):
+    if sinks is None:
+        # without a "sinks" section post to the discordwebhook as before
+        sinks = []
         if discordwebhook:
-            await discord(discordwebhook, title, content)
-        logger.info("%s:%s" % (title, content))
+            sinks.append(DiscordSink(discordwebhook, logger=logger))
+    else:
+        sinks = build_sinks(sinks, logger=logger)
+    # undelivered notifications survive outages of the sinks and restarts
+    spool = Spool(spool_path) if spool_path else None
+    pipeline = SinkPipeline(sinks, spool=spool, logger=logger)
+    pipeline.start()
+
+    # with routes every execution goes to the sinks of the rules it matches only
+    names = [sink.name for sink in sinks]
+    routing = {'router': Router(routes, names) if routes is not None else None,
+               'priorities': Priorities(priorities)}
+
+    # BitMEX may replay recent executions when execution is resubscribed
+    dedup = ExecutionDeduplicator(path=dedup_path)
+    duplicates = DUPLICATES.labels()
+    # one child per execType, looked up once
+    executions = {}
+
+    def execution_counter(exec_type):
+        counter = executions.get(exec_type)
+        if counter is None:
+            counter = executions[exec_type] = EXECUTIONS.labels(exec_type)
+        return counter
+
+    def render(channel, rows):
+        rendered = []
+        for o in rows:
+            fields = {"account": channel, "table": "execution", "exec_type": o.get("execType"),
+                      "symbol": o.get("symbol"), "category": "execution"}
+            message = execution_formatter.render(channel, o, instruments)
+            if message is None:
+                logger.warning("unknow order %s", o, extra=fields)
+                continue
+            logger.info("%s:%s", message[0], message[1], extra=fields)
+            rendered.append((o, message))
+        return rendered
+
+    def publish(channel, rows):
+        rendered = render(channel, rows)
+        if not rendered:
+            return
+        router = routing['router']
+        priorities = routing['priorities']
+        groups = {}
+        for o, message in rendered:
+            destinations = router.route(channel, o) if router is not None else None
+            if destinations is not None and not destinations:
+                logger.debug("'channel:%s' no route for execution %s", channel, o.get("execID"),
+                             extra={"account": channel, "category": "route"})
+                continue
+            groups.setdefault((destinations, priorities.of(o)), []).append(message)
+        # most urgent first, the sinks serve them by priority anyway
+        for (destinations, priority), messages in sorted(groups.items(), key=lambda item: item[0][1]):
+            pipeline.publish(channel, messages, destinations, priority)
+
+    def emit(channel, o):
+        publish(channel, [o])
+
+    # partial fills within digest_window seconds are sent as one digest
+    aggregator = FillAggregator(digest_window, emit, logger=logger)
 
     async def execution_handler(channel, table, data):
         action = data["action"]
         if action != 'insert':
             return
 
-        logger.debug(json.dumps(data))
-
-        data = data['data']
-
-        for o in data:
-            exec_type = o["execType"] 
-            if exec_type == "New":
-                await process_new_order(channel, o, log)
-            elif exec_type == "Trade":
-                await process_trade_order(channel, o, log)
-            elif exec_type == "Canceled":
-                await process_cancel_order(channel, o, log)
-            elif exec_type == "Restated":
-                await process_restated_order(channel, o, log)
-            elif exec_type == "TriggeredOrActivatedBySystem":
-                await process_trigger_order(channel, o, log)
-            elif exec_type == "Rejected":
-                await process_rejected_order(channel, o, log)
-            elif exec_type == "Funding":
-                await process_funding_order(channel, o, log)
-            else:
-                logger.warning("unknow order", json.dumps(o))
+        logger.debug("execution %s", data)
 
-    bm = BitmexMultiplexingAsyncWebsocket(testnet=testnet, logger=logger)
+        rows = []
+        for o in data['data']:
+            if dedup.check(channel, o.get("execID")):
+                duplicates.inc()
+                logger.debug("'channel:%s' skip duplicate execution %s", channel, o.get("execID"),
+                             extra={"account": channel, "category": "duplicate"})
+                continue
+
+            execution_counter(o.get("execType")).inc()
+            rows.extend(aggregator.add(channel, o))
+
+        dedup.flush()
+        publish(channel, rows)
+
+    # executions missed while reconnecting are fetched from REST
+    recovery = ExecutionRecovery(testnet=testnet, endpoint=rest_endpoint, logger=logger)
+    handler = recovery.handler(execution_handler)
+
+    if shards > 1:
+        # a recorder is written from one loop only, so it is not shared by shards
+        if record:
+            logger.warning("recording is not supported with shards, ignore %s", record)
+        bm = BitmexShardedWebsocket(testnet=testnet, shards=shards, logger=logger, endpoint=endpoint)
+    else:
+        recorder = FrameRecorder(record) if record else None
+        bm = BitmexMultiplexingAsyncWebsocket(testnet=testnet, logger=logger, recorder=recorder, endpoint=endpoint)
     for account in accounts:
         name = account['name']
         key = account['key']
         secret = account['secret']
         bm.add_account(name, key, secret)
+        recovery.add_account(name, key, secret)
+    bm.on_disconnect(recovery.disconnected)
+    bm.on_resubscribe(recovery.recover)
 
     bm.open()
 
     for account in accounts:
         name = account['name']
-        bm.subscribe_private_topic(name, "execution", handler=execution_handler)
+        bm.subscribe_private_topic(name, "execution", handler=handler)
+
+    if bm.wait_ready(timeout=30):
+        logger.info("all accounts were verified and subscribed")
+    else:
+        logger.error("some accounts were not verified or subscribed in time")
+
+    # what was applied so far, per account, so a failed reload is retried by the next one
+    running = dict((account['name'], account) for account in accounts)
+
+    def reload(config):
+        # only the channels of the changed accounts are opened or closed
+        new_accounts = config.get("accounts") or []
+        if not new_accounts:
+            logger.error("no accounts in the reloaded config, keep the running ones")
+            return
+
+        added, removed, changed = diff_accounts(list(running.values()), new_accounts)
+        failed = []
+        for account in removed + changed:
+            name = account['name']
+            try:
+                bm.remove_account(name)
+            except Exception as e:
+                logger.error("failed to remove account %s: %s", name, e)
+                failed.append(name)
+                continue
+            recovery.remove_account(name)
+            running.pop(name, None)
+        for account in added + changed:
+            name = account['name']
+            if name in running:
+                # its old key could not be removed
+                continue
+            try:
+                bm.add_account(name, account['key'], account['secret'])
+                recovery.add_account(name, account['key'], account['secret'])
+                bm.subscribe_private_topic(name, "execution", handler=handler)
+            except Exception as e:
+                logger.error("failed to add account %s: %s", name, e)
+                failed.append(name)
+                continue
+            running[name] = account
+        if added or removed or changed:
+            names_of = lambda accounts: [a['name'] for a in accounts if a['name'] not in failed]
+            logger.info("reloaded accounts, added %s removed %s changed %s",
+                        names_of(added), names_of(removed), names_of(changed))
+
+        if config.get("sinks") is not None:
+            # new or removed sinks take a restart, their routes are updated in place
+            routes = dict((sink.get("name") or sink.get("type"), sink.get("accounts")) for sink in config["sinks"])
+            unknown = set(routes) ^ set(sink.name for sink in pipeline.sinks)
+            if unknown:
+                logger.warning("sinks %s were added or removed, restart to apply them", sorted(unknown))
+            pipeline.set_routes(routes)
+
+        if config.get("routes") is not None:
+            # compiled before the swap, a broken rule keeps the running ones
+            try:
+                routing['router'] = Router(config["routes"], names)
+            except Exception as e:
+                logger.error("failed to compile the reloaded routes, keep the running ones: %s", e)
+            else:
+                logger.info("reloaded %d routes", len(config["routes"]))
+
+        if config.get("priorities") is not None:
+            try:
+                routing['priorities'] = Priorities(config["priorities"])
+            except Exception as e:
+                logger.error("failed to apply the reloaded priorities, keep the running ones: %s", e)
+
+        if failed:
+            # the watcher applies the config again at its next poll
+            raise Exception("accounts %s were not reloaded" % failed)
+
+    watcher = None
+    if config_path is not None:
+        watcher = ConfigWatcher(config_path, reload, logger=logger)
+        watcher.start()
 
     bm.wait()
+    if watcher is not None:
+        watcher.stop()
+    aggregator.flush()
+    pipeline.stop(timeout=30)
@@ -0,0 +1,69 @@
+from collections import deque
+
+import metrics
+
+PING_RTT = metrics.REGISTRY.histogram(
+    "bitmex_ping_rtt_seconds", "Round trip time of the websocket pings.", ["client"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+DEAD = metrics.REGISTRY.counter(
+    "bitmex_dead_connections_total", "Connections given up because of missed pongs or silence.", ["client", "reason"])
+
+
+class Heartbeat(object):
+    """
+    Ping bookkeeping of one connection.
+
+    Every ping is timestamped and matched with the next pong (BitMEX answers
+    them in order), which gives the round trip time. check() declares the
+    connection dead once more than max_missed pings are unanswered or nothing
+    at all was received for silence_timeout seconds.
+    """
+    MISSED_PONGS = "missed_pongs"
+    SILENCE = "silence"
+
+    def __init__(self, name, interval=5, max_missed=3, silence_timeout=30, window=100):
+        self.name = name
+        self.interval = interval
+        self.max_missed = max_missed
+        self.silence_timeout = silence_timeout
+
+        self.outstanding = deque()
+        self.rtts = deque(maxlen=window)
+        self.last_recv = None
+        self.histogram = PING_RTT.labels(name)
+
+    def reset(self, now):
+        self.outstanding.clear()
+        self.last_recv = now
+
+    def ping(self, now):
+        self.outstanding.append(now)
+
+    def pong(self, now):
+        if not self.outstanding:
+            return None
+        rtt = now - self.outstanding.popleft()
+        self.rtts.append(rtt)
+        self.histogram.observe(rtt)
+        return rtt
+
+    def check(self, now):
+        """Return why the connection is dead, None while it is alive."""
+        if len(self.outstanding) > self.max_missed:
+            reason = self.MISSED_PONGS
+        elif self.last_recv is not None and now - self.last_recv > self.silence_timeout:
+            reason = self.SILENCE
+        else:
+            return None
+        DEAD.labels(self.name, reason).inc()
+        return reason
+
+    def stats(self):
+        rtts = sorted(self.rtts)
+        return {
+            'last': self.rtts[-1] if self.rtts else None,
+            'p50': rtts[len(rtts) // 2] if rtts else None,
+            'p99': rtts[min(len(rtts) - 1, len(rtts) * 99 // 100)] if rtts else None,
+            'max': rtts[-1] if rtts else None,
+            'missed': len(self.outstanding),
+        }
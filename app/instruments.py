@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import namedtuple
+from decimal import Decimal
+
+import aiohttp
+
+Instrument = namedtuple("Instrument", [
+    "symbol",
+    "tick_size",
+    "lot_size",
+    "multiplier",
+    "contract_type",
+    "underlying",
+    "quote_currency",
+    "settle_currency",
+    "decimals",
+])
+
+
+def tick_decimals(tick_size):
+    """Number of decimals a price needs to show a tick, 0.5 -> 1 and 0.00000001 -> 8."""
+    if not tick_size:
+        return 8
+    return max(0, -Decimal(repr(float(tick_size))).normalize().as_tuple().exponent)
+
+
+def _instrument(row):
+    return Instrument(
+        symbol=row["symbol"],
+        tick_size=row.get("tickSize"),
+        lot_size=row.get("lotSize"),
+        multiplier=row.get("multiplier"),
+        contract_type=row.get("typ"),
+        underlying=row.get("underlying"),
+        quote_currency=row.get("quoteCurrency"),
+        settle_currency=row.get("settlCurrency"),
+        decimals=tick_decimals(row.get("tickSize")),
+    )
+
+
+class InstrumentCatalogue(object):
+    """
+    Symbol metadata of the active BitMEX instruments.
+
+    The catalogue is loaded from the cache file on start and is refreshed from
+    the REST API by a daemon thread, so startup never waits on the API. A lookup
+    of an unknown symbol returns None and callers fall back to their defaults.
+    """
+    MAINNET_ENDPOINT = "https://www.bitmex.com/api/v1"
+    TESTNET_ENDPOINT = "https://testnet.bitmex.com/api/v1"
+    PATH = "/instrument/active"
+    COLUMNS = ["symbol", "tickSize", "lotSize", "multiplier", "typ", "underlying", "quoteCurrency", "settlCurrency"]
+
+    def __init__(self, testnet=False, path=None, ttl=60 * 60, endpoint=None, timeout=10, retry_interval=60,
+                 logger=None):
+        self.endpoint = self.TESTNET_ENDPOINT if testnet else self.MAINNET_ENDPOINT
+        if endpoint is not None:
+            self.endpoint = endpoint
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+        # replaced as a whole on refresh, readers never see a partial catalogue
+        self.instruments = {}
+        self.fetched_at = 0
+        self.thread = None
+        self.loop = None
+        self.task = None
+
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+            self._set(cache["instruments"], cache["fetched_at"])
+        except Exception:
+            self.logger.warning("failed to load instrument cache %s: %s", self.path, traceback.format_exc())
+            return
+        self.logger.info("loaded %d instruments from %s", len(self.instruments), self.path)
+
+    def _save(self, rows):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"fetched_at": self.fetched_at, "instruments": rows}, f)
+        os.replace(tmp, self.path)
+
+    def _set(self, rows, fetched_at):
+        self.instruments = dict((row["symbol"], _instrument(row)) for row in rows)
+        self.fetched_at = fetched_at
+
+    def get(self, symbol):
+        return self.instruments.get(symbol)
+
+    def symbols(self):
+        return list(self.instruments)
+
+    def __contains__(self, symbol):
+        return symbol in self.instruments
+
+    def __len__(self):
+        return len(self.instruments)
+
+    def is_stale(self):
+        return time.time() - self.fetched_at >= self.ttl
+
+    async def fetch(self, session):
+        params = {"columns": json.dumps(self.COLUMNS)}
+        async with session.get(self.endpoint + self.PATH, params=params) as r:
+            if r.status != 200:
+                raise Exception("instrument request failed with status %d: %s" % (r.status, await r.text()))
+            rows = await r.json()
+        return [dict((k, row.get(k)) for k in self.COLUMNS) for row in rows]
+
+    async def refresh(self, session):
+        rows = await self.fetch(session)
+        self._set(rows, time.time())
+        if self.path is not None:
+            self._save(rows)
+        self.logger.info("refreshed %d instruments from %s", len(self.instruments), self.endpoint)
+
+    async def run(self):
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                delay = self.ttl - (time.time() - self.fetched_at)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    await self.refresh(session)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.warning("failed to refresh instruments, retry in %ds: %s", self.retry_interval, e)
+                    await asyncio.sleep(self.retry_interval)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.run())
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
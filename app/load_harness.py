@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+
+import click
+from aiohttp import web
+
+from forwarder import forwarder
+from logger import logger
+from mock_server import MockRealtimeServer, MockRestServer, free_port
+from replay import percentile
+
+SENT = re.compile(r"sent=(\d+\.\d+)")
+
+
+class WebhookSink(object):
+    """Stand-in for the Discord webhook, it times every execution it receives."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.runner = None
+        self.requests = 0
+        self.latencies = []
+
+    @property
+    def url(self):
+        return "http://%s:%d/webhook" % (self.host, self.port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/webhook", self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        if not self.port:
+            self.port = free_port(self.host)
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def _handle(self, request):
+        now = time.time()
+        payload = await request.json()
+        self.requests += 1
+        texts = [embed.get("description", "") for embed in payload.get("embeds", [])]
+        texts.append(payload.get("content") or "")
+        for text in texts:
+            m = SENT.search(text)
+            if m:
+                self.latencies.append(now - float(m.group(1)))
+        return web.Response(status=204, headers={"X-RateLimit-Remaining": "1000", "X-RateLimit-Reset-After": "1"})
+
+
+async def run(accounts, rates, duration, latency, drop_after):
+    rest = MockRestServer()
+    server = MockRealtimeServer(rates=rates, latency=latency, drop_after=drop_after, rest=rest)
+    sink = WebhookSink()
+    await rest.start()
+    await server.start()
+    await sink.start()
+
+    config = [{"name": "account%d" % i, "key": "key%d" % i, "secret": "secret%d" % i} for i in range(accounts)]
+    thread = threading.Thread(target=forwarder,
+                              args=(True, config, sink.url),
+                              kwargs={"endpoint": server.endpoint, "rest_endpoint": rest.endpoint},
+                              daemon=True)
+    thread.start()
+
+    await asyncio.sleep(duration)
+    sent = server.sent
+    await server.stop()
+    await sink.stop()
+    await rest.stop()
+    return server, sink, sent
+
+
+@click.command()
+@click.option('--accounts', default=10, help='number of accounts')
+@click.option('--rate', default=20.0, help='execution frames per second per account')
+@click.option('--duration', default=10.0, help='seconds to run')
+@click.option('--latency', default=0.0, help='seconds the mock server delays every frame')
+@click.option('--drop-after', default=None, type=float, help='mock server closes connections after seconds')
+def main(accounts, rate, duration, latency, drop_after):
+    logger.setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    server, sink, sent = loop.run_until_complete(
+        run(accounts, {"execution": rate}, duration, latency, drop_after))
+
+    latencies = sink.latencies
+    click.echo("%d accounts, %d connections, %d frames sent in %.1fs" % (accounts, server.connections, sent, duration))
+    click.echo("%d executions delivered in %d webhook calls, %.0f executions/sec" % (
+        len(latencies), sink.requests, len(latencies) / duration))
+    if latencies:
+        click.echo("notification latency p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms" % (
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000,
+            max(latencies) * 1000))
+
+
+if __name__ == '__main__':
+    main()
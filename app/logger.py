@@ -1,4 +1,10 @@
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
 
 
 logger = logging.getLogger("bitmex-fordwader")
@@ -8,3 +14,158 @@ ch.setLevel(logging.INFO)
 formatter = logging.Formatter("[%(asctime)s %(levelname)s %(filename)s@%(lineno)d]:  %(message)s")
 ch.setFormatter(formatter)
 logger.addHandler(ch)
+
+# extra fields of a record which end up in the json lines
+FIELDS = ("account", "table", "exec_type", "symbol", "category")
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line with the fields passed in extra."""
+
+    def format(self, record):
+        line = {
+            "ts": record.created,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "where": "%s@%d" % (record.filename, record.lineno),
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                line[field] = value
+        if record.exc_info:
+            line["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep one of every 1/rate records per category, e.g. {"execution": 0.01}.
+
+    Counting instead of drawing random numbers keeps the filter cheap and the
+    sampled lines evenly spread. Records without a category are all kept.
+    """
+
+    def __init__(self, rates):
+        super(SamplingFilter, self).__init__()
+        self.every = dict((category, max(1, int(round(1 / rate))) if rate > 0 else None)
+                          for category, rate in rates.items())
+        self.counts = dict((category, 0) for category in rates)
+
+    def filter(self, record):
+        category = getattr(record, "category", None)
+        if category not in self.every:
+            return True
+        every = self.every[category]
+        if every is None:
+            return False
+        count = self.counts[category]
+        self.counts[category] = count + 1
+        return count % every == 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # only the message is rendered on the caller's thread, the records stay
+        # in process, so formatting and writing are left to the listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class _Writer(object):
+    """
+    Write the queued records from a daemon thread.
+
+    Everything queued meanwhile is formatted and written at once with a single
+    flush, so the thread spends little time holding the GIL per record.
+    """
+    BATCH = 1000
+
+    def __init__(self, q, stream, formatter):
+        self.queue = q
+        self.stream = stream
+        self.formatter = formatter
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            records = [self.queue.get()]
+            while len(records) < self.BATCH:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in records:
+                if record is None:
+                    stop = True
+                    continue
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception:
+                    lines.append("failed to format %r" % record.msg)
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    pass
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+_listener = None
+
+
+def setup_logging(json_lines=False, queued=True, sampling=None, level=logging.INFO, stream=None):
+    """
+    Replace the handler of the logger.
+
+    With queued the records are put on an unbounded queue and written in
+    batches by a background thread, so a slow stdout never blocks the loops.
+    json_lines writes structured lines, sampling maps categories to the rate
+    kept.
+    """
+    global _listener
+    stop_logging()
+
+    stream = stream if stream is not None else sys.stderr
+    line_formatter = JsonFormatter() if json_lines else formatter
+
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+    for f in list(logger.filters):
+        logger.removeFilter(f)
+
+    logger.setLevel(level)
+    if sampling:
+        # filtered before the queue, dropped records cost nothing more
+        logger.addFilter(SamplingFilter(sampling))
+
+    if queued:
+        q = queue.Queue()
+        logger.addHandler(_QueueHandler(q))
+        _listener = _Writer(q, stream, line_formatter)
+        _listener.start()
+    else:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(line_formatter)
+        logger.addHandler(handler)
+    return logger
+
+
+def stop_logging():
+    """Flush the records still queued, call before exiting."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,305 @@
+import asyncio
+import itertools
+import json
+import logging
+import random
+import socket
+import time
+
+import click
+import websockets
+from aiohttp import web
+
+
+class MockRealtimeServer(object):
+    """
+    Local websocket server speaking the realtimemd multiplexing protocol.
+
+    It answers channel open/close, authKey and subscribe/unsubscribe ops the way
+    BitMEX does and streams synthetic rows for every subscription at
+    rates[table] frames per second. latency delays every frame and drop_after
+    closes each connection after that many seconds to exercise reconnects;
+    stall_after instead keeps it open but stops sending anything, pongs
+    included, like a half-open socket. With a rest server every generated
+    execution is also stored there, sent or not, to exercise gap recovery.
+    Private tables are refused on channels which were not authenticated.
+    """
+    MESSAGE_TYPE = 0
+    SUBSCRIBE_TYPE = 1
+    UNSUBSCRIBE_TYPE = 2
+
+    TICK = 0.01
+    SYMBOL = "XBTUSD"
+    PRIVATE_TABLES = ("affiliate", "execution", "order", "margin", "position", "privateNotifications",
+                      "transact", "wallet")
+    BOOK_DEPTH = 50
+
+    def __init__(self, host="127.0.0.1", port=0, rates=None, latency=0, drop_after=None,
+                 rejected_keys=(), stall_after=None, rest=None, logger=None):
+        self.host = host
+        self.port = port
+        self.rates = rates or {}
+        self.latency = latency
+        self.drop_after = drop_after
+        self.stall_after = stall_after
+        self.rest = rest
+        self.rejected_keys = set(rejected_keys)
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+        self.server = None
+        self.ids = itertools.count()
+        self.sent = 0
+        self.connections = 0
+
+    @property
+    def endpoint(self):
+        return "ws://%s:%d" % (self.host, self.port)
+
+    async def start(self):
+        self.server = await websockets.serve(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _stalled(self, ws):
+        return self.stall_after is not None and time.time() - ws.opened_at >= self.stall_after
+
+    async def _send(self, ws, channel, payload):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._stalled(ws):
+            return
+        await ws.send(json.dumps([self.MESSAGE_TYPE, channel, channel, payload], separators=(',', ':')))
+        self.sent += 1
+
+    async def _handle(self, ws, path=None):
+        self.connections += 1
+        ws.opened_at = time.time()
+        ws.keys = {}
+        streams = {}
+        drop = None
+        if self.drop_after:
+            drop = asyncio.get_event_loop().call_later(self.drop_after, lambda: asyncio.ensure_future(ws.close()))
+        try:
+            async for message in ws:
+                if message == "ping":
+                    if not self._stalled(ws):
+                        await ws.send("pong")
+                    continue
+
+                t, channel, _, *rest = json.loads(message)
+                if t == self.SUBSCRIBE_TYPE:
+                    await self._send(ws, channel, {"info": "Welcome to the BitMEX Realtime API.", "version": "mock"})
+                elif t == self.UNSUBSCRIBE_TYPE:
+                    for key in [key for key in streams if key[0] == channel]:
+                        streams.pop(key).cancel()
+                else:
+                    await self._op(ws, channel, rest[0], streams)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if drop is not None:
+                drop.cancel()
+            for task in streams.values():
+                task.cancel()
+
+    async def _op(self, ws, channel, request, streams):
+        op, args = request.get("op"), request.get("args", [])
+        if op == "authKey":
+            if args and args[0] in self.rejected_keys:
+                await self._send(ws, channel, {"status": 401, "error": "Invalid API Key.", "request": request})
+            else:
+                ws.keys[channel] = args[0] if args else None
+                await self._send(ws, channel, {"success": True, "request": request})
+        elif op == "subscribe":
+            for arg in args:
+                table = arg.split(":")[0]
+                if table in self.PRIVATE_TABLES and channel not in ws.keys:
+                    await self._send(ws, channel, {
+                        "status": 401, "request": request,
+                        "error": "User requested an account-locked subscription but no authorization was provided."})
+                    continue
+                await self._send(ws, channel, {"success": True, "subscribe": arg, "request": request})
+                streams[(channel, arg)] = asyncio.ensure_future(self._stream(ws, channel, table, ws.keys.get(channel)))
+        elif op == "unsubscribe":
+            for arg in args:
+                task = streams.pop((channel, arg), None)
+                if task is not None:
+                    task.cancel()
+                await self._send(ws, channel, {"success": True, "unsubscribe": arg, "request": request})
+        else:
+            await self._send(ws, channel, {"status": 400, "error": "Unknown op %s" % op, "request": request})
+
+    async def _stream(self, ws, channel, table, key=None):
+        generate = getattr(self, "_%s_rows" % table, self._trade_rows)
+        keys = {"execution": ["execID"], "order": ["orderID"], "orderBookL2": ["symbol", "id", "side"]}.get(table, [])
+
+        await self._send(ws, channel, {"table": table, "action": "partial", "keys": keys,
+                                       "data": generate(partial=True)})
+
+        rate = self.rates.get(table, 0)
+        credit = 0.0
+        while rate:
+            await asyncio.sleep(self.TICK)
+            credit += rate * self.TICK
+            while credit >= 1:
+                credit -= 1
+                action = "update" if table == "orderBookL2" else "insert"
+                rows = generate()
+                if self.rest is not None and table == "execution":
+                    self.rest.add_executions(key, rows)
+                await self._send(ws, channel, {"table": table, "action": action, "data": rows})
+
+    def _execution_rows(self, partial=False):
+        # transactTime has milliseconds, so recovery can order the rows of a second
+        if partial:
+            return []
+        n = next(self.ids)
+        exec_type, ord_status = random.choice([
+            ("New", "New"), ("Trade", "PartiallyFilled"), ("Trade", "Filled"), ("Canceled", "Canceled"),
+        ])
+        qty = random.randint(1, 100) * 100
+        return [{
+            "execID": "exec-%d" % n,
+            "orderID": "order-%d" % (n // 4),
+            "symbol": self.SYMBOL,
+            "side": random.choice(["Buy", "Sell"]),
+            "price": round(6500 + random.uniform(-50, 50), 1),
+            "stopPx": None,
+            "orderQty": qty,
+            "lastQty": qty // 2,
+            "leavesQty": qty // 2,
+            "ordType": "Limit",
+            "ordStatus": ord_status,
+            "execType": exec_type,
+            "execComm": 0,
+            "exDestination": "XBME",
+            "simpleLeavesQty": 0,
+            # the load harness reads the send time back from the notification
+            "text": "sent=%.6f" % time.time(),
+            "transactTime": _timestamp(),
+        }]
+
+    def _order_rows(self, partial=False):
+        return self._execution_rows(partial)
+
+    def _trade_rows(self, partial=False):
+        if partial:
+            return []
+        return [{
+            "symbol": self.SYMBOL,
+            "side": random.choice(["Buy", "Sell"]),
+            "size": random.randint(1, 1000),
+            "price": round(6500 + random.uniform(-50, 50), 1),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        }]
+
+    def _orderBookL2_rows(self, partial=False):
+        if partial:
+            rows = []
+            for i in range(self.BOOK_DEPTH):
+                rows.append({"symbol": self.SYMBOL, "id": 8799350000 - i, "side": "Sell",
+                             "size": random.randint(1, 1000), "price": 6500.5 + i * 0.5})
+                rows.append({"symbol": self.SYMBOL, "id": 8799350001 + i, "side": "Buy",
+                             "size": random.randint(1, 1000), "price": 6500.0 - i * 0.5})
+            return rows
+        i = random.randrange(self.BOOK_DEPTH)
+        side = random.choice(["Buy", "Sell"])
+        level_id = 8799350001 + i if side == "Buy" else 8799350000 - i
+        return [{"symbol": self.SYMBOL, "id": level_id, "side": side, "size": random.randint(1, 1000)}]
+
+
+def free_port(host):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def _timestamp(ts=None):
+    ts = ts if ts is not None else time.time()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)) + ".%03dZ" % (int(ts * 1000) % 1000)
+
+
+class MockRestServer(object):
+    """
+    Local stand-in for the parts of the BitMEX REST API the forwarder uses.
+
+    /execution serves the executions stored per API key with startTime,
+    count, start and reverse; requests without the auth headers are refused.
+    /instrument/active serves INSTRUMENTS.
+    """
+    INSTRUMENTS = [{
+        "symbol": "XBTUSD", "tickSize": 0.5, "lotSize": 1, "multiplier": -100000000, "typ": "FFWCSX",
+        "underlying": "XBT", "quoteCurrency": "USD", "settlCurrency": "XBt",
+    }]
+
+    def __init__(self, host="127.0.0.1", port=0, logger=None):
+        self.host = host
+        self.port = port
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+        self.runner = None
+        self.executions = {}
+        self.requests = 0
+
+    @property
+    def endpoint(self):
+        return "http://%s:%d/api/v1" % (self.host, self.port)
+
+    def add_executions(self, key, rows):
+        self.executions.setdefault(key, []).extend(rows)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/v1/execution", self._execution)
+        app.router.add_get("/api/v1/instrument/active", self._instruments)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        if not self.port:
+            self.port = free_port(self.host)
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def _execution(self, request):
+        self.requests += 1
+        key = request.headers.get("api-key")
+        if not key or not request.headers.get("api-signature") or not request.headers.get("api-expires"):
+            return web.json_response({"error": {"message": "Not logged in", "name": "HTTPError"}}, status=401)
+
+        rows = sorted(self.executions.get(key, []), key=lambda o: o["transactTime"])
+        start_time = request.query.get("startTime")
+        if start_time:
+            rows = [o for o in rows if o["transactTime"] >= start_time]
+        if request.query.get("reverse") == "true":
+            rows.reverse()
+        start = int(request.query.get("start", 0))
+        count = int(request.query.get("count", 100))
+        return web.json_response(rows[start:start + count])
+
+    async def _instruments(self, request):
+        self.requests += 1
+        return web.json_response(self.INSTRUMENTS)
+
+
+@click.command()
+@click.option('--port', default=8765, help='port to listen on')
+@click.option('--rate', 'rates', multiple=True, help='table=frames per second, e.g. execution=100')
+@click.option('--latency', default=0.0, help='seconds to delay every frame')
+@click.option('--drop-after', default=None, type=float, help='close every connection after seconds')
+@click.option('--stall-after', default=None, type=float, help='stop sending on every connection after seconds')
+def main(port, rates, latency, drop_after, stall_after):
+    rates = dict((table, float(rate)) for table, rate in (r.split("=") for r in rates))
+    server = MockRealtimeServer(port=port, rates=rates, latency=latency, drop_after=drop_after,
+                                stall_after=stall_after)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start())
+    click.echo("listening on %s" % server.endpoint)
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,203 @@
+import asyncio
 import json
+import random
+import time
 
 import aiohttp
 
+import metrics
+from logger import logger
 
-async def discord(webhook, title, content):
-    payload = json.dumps({'username': title, 'content': content})
-    headers = {'content-type': "application/json"}
-    async with aiohttp.ClientSession() as session:
-        html = await session.post(webhook, data=payload, headers=headers)
+WEBHOOK_REQUESTS = metrics.REGISTRY.counter(
+    "discord_webhook_requests_total", "Discord webhook requests per response status.", ["status"])
+WEBHOOK_LATENCY = metrics.REGISTRY.histogram(
+    "discord_webhook_seconds", "Latency of the Discord webhook requests.")
+WEBHOOK_FAILURES = metrics.REGISTRY.counter(
+    "discord_webhook_failures_total", "Notifications dropped after all retries or rejected.")
+
+
+class WebhookRejected(Exception):
+    """The webhook refused the request for good (a 4xx other than 429), retrying would not help."""
+
+    def __init__(self, message, delivered=0):
+        super(WebhookRejected, self).__init__(message)
+        # messages of the batch delivered before the refused one
+        self.delivered = delivered
+
+
+class DiscordNotifier(object):
+    MAX_RETRY = 5
+    # discord accepts up to 10 embeds and 6000 characters of them per message
+    MAX_EMBEDS = 10
+    MAX_EMBEDS_LENGTH = 6000
+    MAX_EMBED_DESCRIPTION = 4096
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30
+
+    def __init__(self, limit=20, keepalive_timeout=60, timeout=10, maxretry=MAX_RETRY, logger=logger):
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.maxretry = maxretry
+        self.logger = logger
+
+        # sessions and locks belong to a loop, the rate limit buckets are shared
+        # by every loop (shards) posting to the same webhook
+        self.sessions = {}
+        self.locks = {}
+        # webhook -> {'remaining': int or None, 'reset': monotonic time}
+        self.buckets = {}
+        self.global_reset = 0
+
+    def _get_session(self):
+        # the session has to be created inside the loop which sends
+        loop = asyncio.get_event_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'content-type': "application/json"},
+            )
+            self.sessions[loop] = session
+        return session
+
+    def _get_bucket(self, webhook):
+        bucket = self.buckets.get(webhook)
+        if bucket is None:
+            bucket = {'remaining': None, 'reset': 0}
+            self.buckets[webhook] = bucket
+        return bucket
+
+    def _get_lock(self, webhook):
+        key = (asyncio.get_event_loop(), webhook)
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[key] = lock
+        return lock
+
+    async def _acquire(self, webhook, bucket):
+        # reserve one request of the bucket, waiting for the reset if it was exhausted
+        async with self._get_lock(webhook):
+            while True:
+                now = time.monotonic()
+                delay = max(self.global_reset, bucket['reset'] if bucket['remaining'] == 0 else 0) - now
+                if delay <= 0:
+                    break
+                self.logger.debug("discord rate limited, wait %.3fs", delay)
+                await asyncio.sleep(delay)
+                if bucket['remaining'] == 0 and bucket['reset'] <= time.monotonic():
+                    bucket['remaining'] = None
+
+            if bucket['remaining']:
+                bucket['remaining'] -= 1
+
+    def _update_bucket(self, bucket, headers):
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining is not None:
+            bucket['remaining'] = int(remaining)
+
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        reset = headers.get("X-RateLimit-Reset")
+        if reset_after is not None:
+            bucket['reset'] = time.monotonic() + float(reset_after)
+        elif reset is not None:
+            bucket['reset'] = time.monotonic() + max(0, float(reset) - time.time())
+
+    def _backoff(self, tried):
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * (2 ** tried))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def send(self, webhook, title, content):
+        payload = json.dumps({'username': title, 'content': content})
+        try:
+            return await self._post(webhook, payload, title)
+        except WebhookRejected:
+            return False
+
+    async def send_batch(self, webhook, messages, username=None):
+        """
+        Render (title, content) messages as embeds, as few webhook calls as possible.
+
+        Stop at the first call which fails and return how many of the messages,
+        in order, were delivered; raise WebhookRejected with that number if the
+        call was refused for good.
+        """
+        delivered = 0
+        for embeds in self._chunk(messages):
+            payload = {'embeds': embeds}
+            if username:
+                payload['username'] = username
+            try:
+                ok = await self._post(webhook, json.dumps(payload), embeds[0]['title'])
+            except WebhookRejected as e:
+                e.delivered = delivered
+                raise
+            if not ok:
+                break
+            delivered += len(embeds)
+        return delivered
+
+    def _chunk(self, messages):
+        embeds, length = [], 0
+        for title, content in messages:
+            embed = {'title': title[:256], 'description': content[:self.MAX_EMBED_DESCRIPTION]}
+            size = len(embed['title']) + len(embed['description'])
+            if embeds and (len(embeds) >= self.MAX_EMBEDS or length + size > self.MAX_EMBEDS_LENGTH):
+                yield embeds
+                embeds, length = [], 0
+            embeds.append(embed)
+            length += size
+        if embeds:
+            yield embeds
+
+    async def _post(self, webhook, payload, title):
+        bucket = self._get_bucket(webhook)
+        latency = WEBHOOK_LATENCY.labels()
+
+        for tried in range(self.maxretry):
+            await self._acquire(webhook, bucket)
+            try:
+                start = time.perf_counter()
+                async with self._get_session().post(webhook, data=payload) as resp:
+                    latency.observe(time.perf_counter() - start)
+                    WEBHOOK_REQUESTS.labels(str(resp.status)).inc()
+                    self._update_bucket(bucket, resp.headers)
+
+                    if resp.status < 300:
+                        return True
+
+                    if resp.status == 429:
+                        retry_after = resp.headers.get("Retry-After")
+                        delay = float(retry_after) if retry_after is not None else self._backoff(tried)
+                        if resp.headers.get("X-RateLimit-Global"):
+                            self.global_reset = time.monotonic() + delay
+                        else:
+                            bucket['remaining'] = 0
+                            bucket['reset'] = time.monotonic() + delay
+                        self.logger.info("discord webhook got 429, retry after %.3fs (%d/%d)", delay, tried + 1, self.maxretry)
+                        continue
+
+                    body = await resp.text()
+                    if resp.status < 500:
+                        self.logger.error("discord webhook rejected with %d: %s", resp.status, body)
+                        WEBHOOK_FAILURES.labels().inc()
+                        raise WebhookRejected("discord webhook rejected with %d: %s" % (resp.status, body))
+
+                    self.logger.info("discord webhook got %d (%d/%d)", resp.status, tried + 1, self.maxretry)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                WEBHOOK_REQUESTS.labels("error").inc()
+                self.logger.info("discord webhook got exception: %s (%d/%d)", repr(e), tried + 1, self.maxretry)
+
+            await asyncio.sleep(self._backoff(tried))
+
+        self.logger.error("discord webhook dropped '%s' after %d attempts", title, self.maxretry)
+        WEBHOOK_FAILURES.labels().inc()
+        return False
+
+    async def close(self):
+        session = self.sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
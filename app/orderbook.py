@@ -0,0 +1,179 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _Side(object):
+    # prices are kept ascending in a contiguous array, sizes are aligned with them
+
+    def __init__(self):
+        self.prices = array('d')
+        self.sizes = array('d')
+
+    def clear(self):
+        del self.prices[:]
+        del self.sizes[:]
+
+    def set(self, price, size):
+        i = bisect_left(self.prices, price)
+        if i < len(self.prices) and self.prices[i] == price:
+            self.sizes[i] = size
+        else:
+            self.prices.insert(i, price)
+            self.sizes.insert(i, size)
+
+    def remove(self, price):
+        i = bisect_left(self.prices, price)
+        if i < len(self.prices) and self.prices[i] == price:
+            del self.prices[i]
+            del self.sizes[i]
+
+    def __len__(self):
+        return len(self.prices)
+
+
+def _vector(a):
+    if numpy is not None:
+        return numpy.frombuffer(a, dtype=numpy.float64) if len(a) else numpy.empty(0)
+    return a
+
+
+class OrderBookL2(object):
+    """
+    Array backed image of one orderBookL2 symbol.
+
+    Levels are addressed by the BitMEX level id, which only maps to the price
+    and side of the level, the sizes live in the per side arrays. Reads return
+    NumPy arrays when NumPy is installed and array.array otherwise.
+    """
+    BUY = "Buy"
+    SELL = "Sell"
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.levels = {}
+        self.bid = _Side()
+        self.ask = _Side()
+
+    def _side(self, side):
+        return self.bid if side == self.BUY else self.ask
+
+    def partial(self, data):
+        self.levels.clear()
+        self.bid.clear()
+        self.ask.clear()
+        self.insert(data)
+
+    def insert(self, data):
+        for level in data:
+            side, price = level["side"], level["price"]
+            self.levels[level["id"]] = (side, price)
+            self._side(side).set(price, level["size"])
+
+    def update(self, data):
+        for level in data:
+            current = self.levels.get(level["id"])
+            if current is None:
+                continue
+            side, price = current
+            new_side = level.get("side", side)
+            if new_side != side:
+                self._side(side).remove(price)
+                self.levels[level["id"]] = (new_side, price)
+            self._side(new_side).set(price, level["size"])
+
+    def delete(self, data):
+        for level in data:
+            current = self.levels.pop(level["id"], None)
+            if current is not None:
+                side, price = current
+                self._side(side).remove(price)
+
+    def bids(self, n=None):
+        """Return (prices, sizes) of the best n bids, best first."""
+        start = 0 if n is None else max(0, len(self.bid) - n)
+        return _vector(self.bid.prices[start:][::-1]), _vector(self.bid.sizes[start:][::-1])
+
+    def asks(self, n=None):
+        """Return (prices, sizes) of the best n asks, best first."""
+        end = len(self.ask) if n is None else n
+        return _vector(self.ask.prices[:end]), _vector(self.ask.sizes[:end])
+
+    def best_bid(self):
+        return self.bid.prices[-1] if len(self.bid) else None
+
+    def best_ask(self):
+        return self.ask.prices[0] if len(self.ask) else None
+
+    def mid(self):
+        bid, ask = self.best_bid(), self.best_ask()
+        if bid is None or ask is None:
+            return None
+        return (bid + ask) / 2
+
+    def spread(self):
+        bid, ask = self.best_bid(), self.best_ask()
+        if bid is None or ask is None:
+            return None
+        return ask - bid
+
+    def depth(self, bps):
+        """Return (bid size, ask size) quoted within bps of the mid."""
+        mid = self.mid()
+        if mid is None:
+            return 0, 0
+        distance = mid * bps / 10000
+        lo = bisect_left(self.bid.prices, mid - distance)
+        hi = bisect_right(self.ask.prices, mid + distance)
+        return sum(self.bid.sizes[lo:]), sum(self.ask.sizes[:hi])
+
+    def imbalance(self, n=None, bps=None):
+        """Return (bid - ask) / (bid + ask) over the best n levels or within bps of the mid."""
+        if bps is not None:
+            bid, ask = self.depth(bps)
+        else:
+            start = 0 if n is None else max(0, len(self.bid) - n)
+            end = len(self.ask) if n is None else n
+            bid, ask = sum(self.bid.sizes[start:]), sum(self.ask.sizes[:end])
+        total = bid + ask
+        return (bid - ask) / total if total else 0.0
+
+
+class OrderBookStore(object):
+    TABLE = "orderBookL2"
+
+    def __init__(self):
+        self.books = {}
+
+    def get(self, symbol):
+        return self.books.get(symbol)
+
+    def apply(self, payload):
+        action = payload.get("action")
+        data = payload.get("data", [])
+
+        # one frame may carry several symbols when subscribing without a symbol
+        groups = {}
+        for level in data:
+            groups.setdefault(level["symbol"], []).append(level)
+
+        for symbol, levels in groups.items():
+            book = self.books.get(symbol)
+            if action == "partial":
+                if book is None:
+                    book = OrderBookL2(symbol)
+                    self.books[symbol] = book
+                book.partial(levels)
+            elif book is None:
+                # deltas before the partial can not be applied
+                continue
+            elif action == "insert":
+                book.insert(levels)
+            elif action == "update":
+                book.update(levels)
+            elif action == "delete":
+                book.delete(levels)
@@ -0,0 +1,79 @@
+import mmap
+import struct
+import time
+import zlib
+
+
+# every block is a header followed by the zlib compressed records, a record is
+# the receive timestamp and the length of the utf-8 frame followed by the frame
+BLOCK_HEADER = struct.Struct("<II")
+RECORD_HEADER = struct.Struct("<dI")
+
+
+class FrameRecorder(object):
+    """
+    Append raw frames to a compressed, append-only file.
+
+    Frames are buffered and written as one compressed block every block_size
+    frames or flush_interval seconds, so a crash loses at most one block.
+    """
+
+    def __init__(self, path, block_size=1000, flush_interval=1.0, level=6):
+        self.path = path
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.level = level
+
+        self.file = open(path, "ab")
+        self.buffer = []
+        self.count = 0
+        self.flushed_at = time.monotonic()
+
+    def write(self, frame, ts=None):
+        data = frame.encode("utf-8") if isinstance(frame, str) else frame
+        self.buffer.append(RECORD_HEADER.pack(ts if ts is not None else time.time(), len(data)))
+        self.buffer.append(data)
+        self.count += 1
+        if self.count >= self.block_size or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.count:
+            block = zlib.compress(b"".join(self.buffer), self.level)
+            self.file.write(BLOCK_HEADER.pack(len(block), self.count))
+            self.file.write(block)
+            self.file.flush()
+            self.buffer = []
+            self.count = 0
+        self.flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_frames(path):
+    """Yield (timestamp, frame) of a recording, the file is memory-mapped."""
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty recording
+            return
+        with mm:
+            offset = 0
+            while offset + BLOCK_HEADER.size <= len(mm):
+                length, count = BLOCK_HEADER.unpack_from(mm, offset)
+                offset += BLOCK_HEADER.size
+                if offset + length > len(mm):
+                    # truncated by a crash while writing the last block
+                    break
+                block = zlib.decompress(mm[offset:offset + length])
+                offset += length
+
+                pos = 0
+                for _ in range(count):
+                    ts, size = RECORD_HEADER.unpack_from(block, pos)
+                    pos += RECORD_HEADER.size
+                    yield ts, block[pos:pos + size].decode("utf-8")
+                    pos += size
@@ -0,0 +1,203 @@
+import asyncio
+import time
+import urllib.parse
+from collections import defaultdict
+
+import aiohttp
+from yarl import URL
+
+import metrics
+from logger import logger
+from bitmex_multiplexing_async_websocket import bitmex_signature
+
+RECOVERED = metrics.REGISTRY.counter(
+    "forwarder_recovered_executions_total", "Executions fetched from REST after a reconnect.")
+RECOVERY_FAILURES = metrics.REGISTRY.counter(
+    "forwarder_recovery_failures_total", "Reconnects after which the missed executions could not be fetched.")
+
+
+class ExecutionRecovery(object):
+    """
+    Fill the gap of a reconnect from the REST /execution endpoint.
+
+    handler() wraps the execution handler and remembers the last transactTime
+    of every account. disconnected() checkpoints that time and holds the live
+    frames of the accounts back from then on; recover() pages through the
+    executions since the checkpoint, oldest first, hands them to the handler
+    as one insert and then releases the live frames, so the handler sees them
+    in order. Rows which were already forwarded are dropped by the
+    deduplicator of the handler.
+
+    Accounts of the client which failed to verify or subscribe again get
+    their held frames released without a fetch. An account holds
+    at most max_held frames for at most hold_timeout seconds, then its frames
+    are released and the rest of its gap is left to the deduplicator.
+    """
+    MAINNET_ENDPOINT = "https://www.bitmex.com/api/v1"
+    TESTNET_ENDPOINT = "https://testnet.bitmex.com/api/v1"
+    PATH = "/execution"
+    VERB = "GET"
+
+    def __init__(self, testnet=False, endpoint=None, page_size=500, max_pages=20, timeout=10, limit=10,
+                 expires=60, max_held=10000, hold_timeout=120, logger=logger):
+        self.endpoint = self.TESTNET_ENDPOINT if testnet else self.MAINNET_ENDPOINT
+        if endpoint is not None:
+            self.endpoint = endpoint
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.limit = limit
+        self.expires = expires
+        self.max_held = max_held
+        self.hold_timeout = hold_timeout
+        self.logger = logger
+
+        self.accounts = {}
+        self.last_seen = {}
+        self.checkpoints = {}
+        self.recovering = set()
+        self.disconnected_at = {}
+        self.held = defaultdict(list)
+        self.handle = None
+        # a session belongs to the loop which recovers, like the notifier
+        self.sessions = {}
+        self.recovered = RECOVERED.labels()
+        self.failures = RECOVERY_FAILURES.labels()
+
+    def add_account(self, name, key, secret):
+        self.accounts[name] = {'key': key, 'secret': secret}
+
+    def remove_account(self, name):
+        self.accounts.pop(name, None)
+        self.last_seen.pop(name, None)
+        self.checkpoints.pop(name, None)
+        self.recovering.discard(name)
+        self.disconnected_at.pop(name, None)
+        self.held.pop(name, None)
+
+    def handler(self, handle):
+        self.handle = handle
+
+        async def execution_handler(channel, table, data):
+            if channel in self.recovering:
+                held = self.held[channel]
+                if (len(held) < self.max_held and
+                        time.monotonic() - self.disconnected_at.get(channel, 0) < self.hold_timeout):
+                    held.append((table, data))
+                    return
+                self.logger.warning("'channel:%s' gave up recovering after holding %d frames", channel, len(held))
+                self.failures.inc()
+                await self._release(channel)
+            self._seen(channel, data)
+            await handle(channel, table, data)
+
+        return execution_handler
+
+    def _seen(self, channel, data):
+        # ISO 8601 timestamps of the same format compare as strings
+        for o in data.get('data', ()):
+            ts = o.get("transactTime")
+            if ts and ts > self.last_seen.get(channel, ""):
+                self.last_seen[channel] = ts
+
+    def _get_session(self):
+        loop = asyncio.get_event_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit),
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.sessions[loop] = session
+        return session
+
+    def _headers(self, account, url):
+        expires = int(time.time()) + self.expires
+        return {
+            'api-expires': str(expires),
+            'api-key': account['key'],
+            'api-signature': bitmex_signature(account['secret'], self.VERB, url, expires),
+        }
+
+    async def fetch(self, name, start_time):
+        """Return the executions of an account since start_time, oldest first."""
+        account = self.accounts[name]
+        rows = []
+        for page in range(self.max_pages):
+            query = urllib.parse.urlencode([
+                ('startTime', start_time),
+                ('count', self.page_size),
+                ('start', page * self.page_size),
+                ('reverse', 'false'),
+            ])
+            url = "%s%s?%s" % (self.endpoint, self.PATH, query)
+            # the signature covers the query as it is sent, so it must not be requoted
+            async with self._get_session().get(URL(url, encoded=True), headers=self._headers(account, url)) as r:
+                if r.status != 200:
+                    raise Exception("execution request failed with status %d: %s" % (r.status, await r.text()))
+                data = await r.json()
+            rows.extend(data)
+            if len(data) < self.page_size:
+                return rows
+        self.logger.warning("'channel:%s' recovered only the first %d executions since %s",
+                            name, len(rows), start_time)
+        return rows
+
+    def disconnected(self, accounts):
+        """Disconnect callback of the client."""
+        now = time.monotonic()
+        for name in accounts:
+            if name not in self.recovering:
+                self.disconnected_at[name] = now
+            self.recovering.add(name)
+            if name in self.last_seen:
+                self.checkpoints[name] = self.last_seen[name]
+
+    async def _recover(self, name):
+        if name not in self.recovering:
+            return
+        start_time = self.checkpoints.pop(name, None)
+        try:
+            if start_time is None or name not in self.accounts:
+                # nothing was seen before the disconnect, there is no gap to fill
+                return
+            rows = await self.fetch(name, start_time)
+            rows.sort(key=lambda o: o.get("transactTime") or "")
+            if rows:
+                self.logger.info("'channel:%s' recovered %d executions since %s", name, len(rows), start_time)
+                self.recovered.inc(len(rows))
+                data = {'table': 'execution', 'action': 'insert', 'data': rows}
+                self._seen(name, data)
+                await self.handle(name, 'execution', data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures.inc()
+            self.logger.error("'channel:%s' failed to recover executions since %s: %s", name, start_time, e)
+        finally:
+            await self._release(name)
+
+    async def _release(self, name):
+        # frames held meanwhile go first, the live ones still arriving queue up behind them
+        held = self.held[name]
+        while held:
+            table, data = held.pop(0)
+            self._seen(name, data)
+            await self.handle(name, table, data)
+        self.recovering.discard(name)
+        self.disconnected_at.pop(name, None)
+        self.held.pop(name, None)
+
+    async def recover(self, accounts, failed=()):
+        """
+        Resubscribe callback of the client, the accounts are recovered
+        concurrently and the frames held for the failed ones are released.
+        Accounts of other clients (shards) still reconnecting are left alone.
+        """
+        for name in [name for name in failed if name in self.recovering]:
+            self.checkpoints.pop(name, None)
+            await self._release(name)
+        await asyncio.gather(*[self._recover(name) for name in accounts])
+
+    async def close(self):
+        session = self.sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
@@ -0,0 +1,87 @@
+import json
+import os
+import signal
+import threading
+import traceback
+
+from logger import logger
+
+
+def diff_accounts(old, new):
+    """Return the (added, removed, changed) accounts of two account lists, changed ones got a new key."""
+    old = dict((account['name'], account) for account in old)
+    new = dict((account['name'], account) for account in new)
+    added = [new[name] for name in new if name not in old]
+    removed = [old[name] for name in old if name not in new]
+    changed = [new[name] for name in new if name in old and
+               (new[name]['key'], new[name]['secret']) != (old[name]['key'], old[name]['secret'])]
+    return added, removed, changed
+
+
+class ConfigWatcher(object):
+    """
+    Call on_change(config) with the parsed config whenever its file changed.
+
+    The file is polled every interval seconds from a daemon thread, SIGHUP or
+    reload() check it right away. A config which can not be parsed is logged
+    and ignored, the running one is kept. If on_change raises, the config is
+    applied again at the next poll.
+    """
+
+    def __init__(self, path, on_change, interval=2.0, logger=logger):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.logger = logger
+
+        self.mtime = None
+        self.thread = None
+        self.closed = False
+        self.event = threading.Event()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def start(self):
+        self.mtime = self._mtime()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        # signal handlers can only be installed by the main thread
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+
+    def reload(self):
+        self.event.set()
+
+    def _run(self):
+        while not self.closed:
+            forced = self.event.wait(self.interval)
+            self.event.clear()
+            if self.closed:
+                return
+
+            mtime = self._mtime()
+            if mtime == self.mtime and not forced:
+                continue
+            self.mtime = mtime
+
+            try:
+                with open(self.path) as f:
+                    config = json.load(f)
+            except Exception as e:
+                self.logger.error("failed to reload %s, keep the running config: %s", self.path, e)
+                continue
+
+            self.logger.info("reload %s", self.path)
+            try:
+                self.on_change(config)
+            except Exception:
+                self.logger.error("failed to apply %s: %s", self.path, traceback.format_exc())
+                self.mtime = None
+
+    def stop(self):
+        self.closed = True
+        self.event.set()
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+
+import click
+
+import codec
+import execution_formatter
+from bitmex_multiplexing_async_websocket import BitmexMultiplexingWebsocket
+from recorder import read_frames
+from logger import logger, setup_logging, stop_logging
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Replayer(object):
+    """Push recorded frames through _dispatch and time the handlers."""
+
+    def __init__(self, client, handlers=None):
+        self.client = client
+        self.handlers = handlers or {}
+        self.latencies = defaultdict(list)
+
+    def _timed(self, table, handler):
+        latencies = self.latencies[table]
+
+        async def timed(channel, table, payload):
+            start = time.perf_counter()
+            await handler(channel, table, payload)
+            latencies.append(time.perf_counter() - start)
+        return timed
+
+    def _register(self, message):
+        # replayed channels were never subscribed, register them on the fly
+        channel, table = codec.peek(message)
+        if table is None or table in self.client.channels.get(channel, ()):
+            return
+        handler = self.handlers.get(table, noop_handler)
+        self.client.channels[channel][table] = {
+            'topic': table,
+            'symbol': None,
+            'handler': self._timed(table, handler),
+        }
+
+    async def run(self, path, pace=False):
+        frames = 0
+        first_ts = None
+        start = time.perf_counter()
+        for ts, message in read_frames(path):
+            if pace:
+                if first_ts is None:
+                    first_ts = ts
+                delay = (ts - first_ts) - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self._register(message)
+            await self.client._dispatch(message)
+            frames += 1
+
+        await self.client.dispatcher.join()
+        return frames, time.perf_counter() - start
+
+
+async def noop_handler(channel, table, payload):
+    pass
+
+
+async def render_handler(channel, table, payload):
+    # what forwarder does with an execution, without the delivery
+    if payload["action"] != "insert":
+        return
+    for o in payload["data"]:
+        execution_formatter.render(channel, o)
+
+
+async def log_handler(channel, table, payload):
+    # render_handler plus the structured line forwarder logs per execution
+    if payload["action"] != "insert":
+        return
+    for o in payload["data"]:
+        message = execution_formatter.render(channel, o)
+        if message is not None:
+            logger.info("%s:%s", message[0], message[1], extra={
+                "account": channel, "table": table, "exec_type": o.get("execType"),
+                "symbol": o.get("symbol"), "category": "execution"})
+
+
+@click.command()
+@click.argument('f', type=click.Path(exists=True))
+@click.option('--pace/--no-pace', default=False, help='replay at the recorded pace instead of as fast as possible')
+@click.option('--log', 'log_mode', type=click.Choice(['none', 'sync', 'queue']), default='none',
+              help='log every execution, written by the handler (sync) or by a background thread (queue)')
+@click.option('--log-to', default=os.devnull, help='file the log lines are written to')
+def main(f, pace, log_mode, log_to):
+    handler = render_handler
+    stream = None
+    if log_mode != 'none':
+        stream = open(log_to, "a")
+        setup_logging(json_lines=True, queued=log_mode == 'queue', stream=stream)
+        handler = log_handler
+
+    client = BitmexMultiplexingWebsocket(logger_level=logging.WARNING)
+    replayer = Replayer(client, handlers={'execution': handler})
+
+    loop = asyncio.get_event_loop()
+    frames, elapsed = loop.run_until_complete(replayer.run(click.format_filename(f), pace=pace))
+    client.dispatcher.close()
+    if stream is not None:
+        stop_logging()
+        stream.close()
+
+    click.echo("json backend: %s" % codec.BACKEND)
+    click.echo("%d frames in %.3fs, %.0f frames/sec, %d skipped" % (
+        frames, elapsed, frames / elapsed if elapsed else 0, client.skipped))
+    for table, latencies in sorted(replayer.latencies.items()):
+        click.echo("%-20s n=%-8d p50=%.3fms p90=%.3fms p99=%.3fms max=%.3fms" % (
+            table, len(latencies),
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000,
+            max(latencies) * 1000 if latencies else 0))
+
+
+if __name__ == '__main__':
+    main()
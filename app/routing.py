@@ -0,0 +1,107 @@
+import re
+
+
+def _values(value):
+    if value is None:
+        return None
+    return frozenset(value) if isinstance(value, (list, tuple, set)) else frozenset([value])
+
+
+class Rule(object):
+    """
+    One route of the config, e.g.
+
+        {"match": {"account": ["a"], "execType": "Trade", "symbol": "XBTUSD",
+                   "side": "Buy", "min_qty": 1000, "max_qty": 100000, "text": "(?i)liquidat"},
+         "sinks": ["big-trades"], "stop": true}
+
+    Every match field is optional, a list matches any of its values. account and
+    execType are indexed by the router, the other fields are checked in turn.
+    """
+    FIELDS = ("account", "execType", "symbol", "side", "min_qty", "max_qty", "text")
+
+    def __init__(self, index, config):
+        match = config.get("match", {})
+        unknown = set(match) - set(self.FIELDS)
+        if unknown:
+            raise Exception("route %d matches on unknow fields %s" % (index, sorted(unknown)))
+        if not config.get("sinks"):
+            raise Exception("route %d has no sinks" % index)
+
+        self.index = index
+        self.accounts = _values(match.get("account"))
+        self.exec_types = _values(match.get("execType"))
+        self.sinks = frozenset(config["sinks"])
+        self.stop = bool(config.get("stop"))
+
+        symbols = _values(match.get("symbol"))
+        sides = _values(match.get("side"))
+        min_qty = match.get("min_qty")
+        max_qty = match.get("max_qty")
+        text = re.compile(match["text"]) if match.get("text") else None
+
+        checks = []
+        if symbols is not None:
+            checks.append(lambda o: o.get("symbol") in symbols)
+        if sides is not None:
+            checks.append(lambda o: o.get("side") in sides)
+        if min_qty is not None:
+            checks.append(lambda o: (o.get("orderQty") or 0) >= min_qty)
+        if max_qty is not None:
+            checks.append(lambda o: (o.get("orderQty") or 0) <= max_qty)
+        if text is not None:
+            checks.append(lambda o: text.search(o.get("text") or "") is not None)
+        self.checks = checks
+
+    def matches(self, o):
+        for check in self.checks:
+            if not check(o):
+                return False
+        return True
+
+
+class Router(object):
+    """
+    Route executions to sinks by rules compiled into a dispatch table.
+
+    Rules are indexed by (account, execType) with None as the wildcard, the
+    candidates of a pair are merged in config order once and cached, so a
+    lookup is one dict get plus the checks of the few rules which can match,
+    no matter how many rules other accounts have. The sinks of every matching
+    rule are returned, a matching rule with stop ends the evaluation.
+    """
+
+    def __init__(self, routes, sinks=None):
+        self.rules = [Rule(i, config) for i, config in enumerate(routes)]
+        if sinks is not None:
+            for rule in self.rules:
+                unknown = rule.sinks - set(sinks)
+                if unknown:
+                    raise Exception("route %d goes to unknow sinks %s" % (rule.index, sorted(unknown)))
+
+        self.index = {}
+        for rule in self.rules:
+            for account in rule.accounts or (None,):
+                for exec_type in rule.exec_types or (None,):
+                    self.index.setdefault((account, exec_type), []).append(rule)
+        self.cache = {}
+
+    def _candidates(self, account, exec_type):
+        key = (account, exec_type)
+        rules = self.cache.get(key)
+        if rules is None:
+            merged = set()
+            for k in (key, (account, None), (None, exec_type), (None, None)):
+                merged.update(self.index.get(k, ()))
+            rules = self.cache[key] = sorted(merged, key=lambda rule: rule.index)
+        return rules
+
+    def route(self, account, o):
+        """Return the names of the sinks an execution goes to, empty if no rule matches."""
+        sinks = frozenset()
+        for rule in self._candidates(account, o.get("execType")):
+            if rule.matches(o):
+                sinks = sinks | rule.sinks
+                if rule.stop:
+                    break
+        return sinks
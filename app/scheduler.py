@@ -0,0 +1,151 @@
+import asyncio
+import time
+from collections import deque
+
+PRIORITIES = ("critical", "high", "normal", "low")
+CRITICAL, HIGH, NORMAL, LOW = range(len(PRIORITIES))
+# after every priority, the sentinel which stops a worker is never shed
+STOP = len(PRIORITIES)
+
+EXEC_TYPE_PRIORITIES = {
+    "Rejected": CRITICAL,
+    "TriggeredOrActivatedBySystem": CRITICAL,
+    "Trade": HIGH,
+    "New": NORMAL,
+    "Canceled": NORMAL,
+    "Replaced": NORMAL,
+    "Restated": LOW,
+    "Funding": LOW,
+    "Settlement": LOW,
+}
+
+
+def parse_priority(name):
+    if name not in PRIORITIES:
+        raise Exception("unknow priority %s, expect one of %s" % (name, list(PRIORITIES)))
+    return PRIORITIES.index(name)
+
+
+class Priorities(object):
+    """The priority of an execution by its execType, overrides map execTypes to priority names."""
+
+    def __init__(self, overrides=None):
+        self.priorities = dict(EXEC_TYPE_PRIORITIES)
+        for exec_type, name in (overrides or {}).items():
+            self.priorities[exec_type] = parse_priority(name)
+
+    def of(self, o):
+        return self.priorities.get(o.get("execType"), NORMAL)
+
+
+class TokenBucket(object):
+    """rate requests per second with bursts of up to burst requests."""
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated = clock()
+
+    def take(self, n=1):
+        """Take n tokens, return the seconds to wait until they are covered."""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= n
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self, n=1):
+        """Wait for n tokens, return whether it had to wait."""
+        delay = self.take(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay > 0
+
+
+class OutboundQueue(object):
+    """
+    The queue of a sink, served by priority and in order within a priority.
+
+    Once shed_at messages are waiting, a new message of shed_priority or lower
+    is collapsed into the queued one of the same account and title, which then
+    carries the latest content and how many were folded into it. When the queue is full the
+    oldest message of the lowest priority goes, unless the new one is lower
+    still, so critical messages are never dropped for less important ones.
+    """
+    COLLAPSED = "collapsed"
+    DROPPED = "dropped"
+    DISPLACED = "displaced"
+
+    def __init__(self, maxsize=0, shed_at=None, shed_priority=LOW):
+        self.maxsize = maxsize
+        self.shed_at = shed_at
+        self.shed_priority = shed_priority
+        self.queues = [deque() for _ in range(STOP + 1)]
+        # the queued entry of every (channel, title) which may be collapsed into
+        self.latest = {}
+        self.size = 0
+        self.event = asyncio.Event()
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def full(self):
+        return 0 < self.maxsize <= self.size
+
+    def put_nowait(self, message, priority=NORMAL, channel=None):
+        """Queue a message of an account, return None or what the shedding did: COLLAPSED, DROPPED or DISPLACED."""
+        outcome = None
+        if message is not None and priority >= self.shed_priority:
+            entry = self.latest.get((channel, message[0]))
+            if entry is not None and self.shed_at is not None and self.size >= self.shed_at:
+                entry[1] = message[1]
+                entry[2] += 1
+                return self.COLLAPSED
+
+        if message is not None and self.full():
+            lowest = next(p for p in range(LOW, -1, -1) if self.queues[p] or p == 0)
+            if lowest < priority or not self.queues[lowest]:
+                return self.DROPPED
+            self._forget(self.queues[lowest].popleft())
+            self.size -= 1
+            outcome = self.DISPLACED
+
+        entry = [message[0], message[1], 0, channel] if message is not None else None
+        self.queues[priority].append(entry)
+        if entry is not None and priority >= self.shed_priority:
+            self.latest[(channel, entry[0])] = entry
+        self.size += 1
+        self.event.set()
+        return outcome
+
+    def _forget(self, entry):
+        if entry is not None and self.latest.get((entry[3], entry[0])) is entry:
+            del self.latest[(entry[3], entry[0])]
+
+    def get_nowait(self):
+        for q in self.queues:
+            if q:
+                entry = q.popleft()
+                self.size -= 1
+                if entry is None:
+                    return None
+                self._forget(entry)
+                title, content, collapsed, _ = entry
+                if collapsed:
+                    content = "%s (+%d collapsed)" % (content, collapsed)
+                return title, content
+        raise asyncio.QueueEmpty()
+
+    async def wait(self):
+        while not self.size:
+            self.event.clear()
+            await self.event.wait()
+
+    async def get(self):
+        await self.wait()
+        return self.get_nowait()
@@ -0,0 +1,535 @@
+import asyncio
+import json
+import queue
+import random
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+import aiohttp
+
+import metrics
+from logger import logger
+from notifier import DiscordNotifier, WebhookRejected
+from scheduler import NORMAL, STOP, OutboundQueue, TokenBucket, parse_priority
+
+SINK_QUEUE = metrics.REGISTRY.gauge(
+    "sink_queue_depth", "Messages waiting to be written per sink.", ["sink"])
+SINK_DROPPED = metrics.REGISTRY.counter(
+    "sink_dropped_total", "Messages dropped because the sink queue was full.", ["sink"])
+SINK_SHED = metrics.REGISTRY.counter(
+    "sink_shed_total", "Low priority messages collapsed or dropped under overload.", ["sink", "action"])
+SINK_FAILURES = metrics.REGISTRY.counter(
+    "sink_failures_total", "Batches a sink failed to write.", ["sink"])
+SINK_LATENCY = metrics.REGISTRY.histogram(
+    "sink_write_seconds", "Time a sink spent writing a batch.", ["sink"])
+SPOOL_SIZE = metrics.REGISTRY.gauge(
+    "sink_spool_size", "Messages waiting in the spool per sink.", ["sink"])
+SPOOL_AGE = metrics.REGISTRY.gauge(
+    "sink_spool_age_seconds", "Age of the oldest message in the spool per sink.", ["sink"])
+
+
+class DeliveryError(Exception):
+    def __init__(self, message, delivered=0):
+        super(DeliveryError, self).__init__(message)
+        # the first messages of the batch which were delivered anyway
+        self.delivered = delivered
+
+
+class RejectedError(DeliveryError):
+    """The destination refused the messages for good, they are dropped instead of retried."""
+
+
+class Sink(object):
+    """
+    A destination of the notifications with its own queue and worker.
+
+    write() receives batches of up to batch_size (title, content) messages; the
+    worker takes what is queued when it is free and waits at most
+    batch_interval for more, so a slow sink batches more instead of falling
+    behind and never delays the other sinks. accounts restricts the sink to the
+    notifications of those accounts.
+
+    Messages are written by priority. rate (writes per second, bursts of up to
+    burst) keeps the sink within the rate limit of its destination, and the
+    worker takes the next batch only once it may write, so urgent messages
+    queued meanwhile still go first. From shed_at waiting messages those of
+    shed_priority and lower are collapsed, in the spool they are dropped.
+
+    A DURABLE sink given a spool appends the messages to it instead and
+    deletes them only once write() succeeded, a failed batch is retried with
+    backoff, after max_attempts it is dropped. The messages a failed write()
+    reports as delivered are acked and never sent again. The rest of a batch
+    raising RejectedError is written message by message and only the refused
+    ones are dropped, so a poison message never blocks the sink.
+    """
+    TYPE = None
+    BATCH_SIZE = 1
+    DURABLE = False
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 60
+    # about three quarters of an hour of retries with the maximum backoff
+    MAX_ATTEMPTS = 50
+
+    def __init__(self, name=None, accounts=None, maxsize=10000, batch_size=None, batch_interval=0,
+                 max_attempts=MAX_ATTEMPTS, rate=None, burst=1, shed_at=None, shed_priority="low", logger=logger):
+        self.name = name or self.TYPE
+        self.accounts = set(accounts) if accounts else None
+        self.maxsize = maxsize
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.batch_interval = batch_interval
+        self.max_attempts = max_attempts
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.shed_at = shed_at
+        self.shed_priority = parse_priority(shed_priority)
+        self.logger = logger
+
+        # created by start() in the loop of the pipeline
+        self.queue = None
+        self.worker = None
+        self.spool = None
+        self.wakeup = None
+        self.stopping = False
+        self.dropped = SINK_DROPPED.labels(self.name)
+        self.failures = SINK_FAILURES.labels(self.name)
+        self.latency = SINK_LATENCY.labels(self.name)
+        self.collapsed = SINK_SHED.labels(self.name, OutboundQueue.COLLAPSED)
+        self.shed = SINK_SHED.labels(self.name, OutboundQueue.DROPPED)
+
+    def accepts(self, channel):
+        return self.accounts is None or channel in self.accounts
+
+    def start(self, spool=None):
+        if spool is not None and self.DURABLE:
+            self.spool = spool
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.ensure_future(self._drain())
+            SPOOL_SIZE.labels(self.name).set_function(lambda: spool.size(self.name))
+            SPOOL_AGE.labels(self.name).set_function(lambda: spool.age(self.name))
+            return
+
+        self.queue = OutboundQueue(self.maxsize, self.shed_at, self.shed_priority)
+        self.worker = asyncio.ensure_future(self._work())
+        SINK_QUEUE.labels(self.name).set_function(lambda: self.queue.qsize())
+
+    def put(self, messages, priority=NORMAL, channel=None):
+        if self.spool is not None:
+            if (self.shed_at is not None and priority >= self.shed_priority and
+                    self.spool.size(self.name) >= self.shed_at):
+                self.shed.inc(len(messages))
+                self.logger.warning("sink %s is overloaded, drop %d low priority messages", self.name, len(messages))
+                return
+            self.spool.append(self.name, messages, priority=priority)
+            self.wakeup.set()
+            return
+
+        for message in messages:
+            outcome = self.queue.put_nowait(message, priority, channel)
+            if outcome == OutboundQueue.COLLAPSED:
+                self.collapsed.inc()
+            elif outcome == OutboundQueue.DROPPED:
+                self.dropped.inc()
+                self.logger.warning("sink %s queue is full, drop a message less urgent than the queued", self.name)
+            elif outcome == OutboundQueue.DISPLACED:
+                self.dropped.inc()
+                self.logger.warning("sink %s queue is full, drop the oldest of the least urgent messages", self.name)
+
+    def _backoff(self, tried):
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * (2 ** tried))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _write(self, batch):
+        """Write a batch, return how many of its first messages are done with, the rest has to be retried."""
+        start = time.perf_counter()
+        try:
+            await self.write(batch)
+            return len(batch)
+        except asyncio.CancelledError:
+            raise
+        except RejectedError as e:
+            done = e.delivered
+            if len(batch) - done > 1:
+                # find the refused messages among those not delivered yet
+                for message in batch[done:]:
+                    if not await self._write([message]):
+                        break
+                    done += 1
+                return done
+            self.failures.inc()
+            self.dropped.inc()
+            self.logger.error("sink %s refused '%s' for good, drop it: %s", self.name, batch[-1][0], e)
+            return len(batch)
+        except DeliveryError as e:
+            self.failures.inc()
+            self.logger.error("sink %s failed to deliver %d of %d messages: %s",
+                              self.name, len(batch) - e.delivered, len(batch), e)
+            return e.delivered
+        except Exception:
+            self.failures.inc()
+            self.logger.error("sink %s failed to write %d messages: %s",
+                              self.name, len(batch), traceback.format_exc())
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+        return 0
+
+    async def _batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_interval
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _work(self):
+        while True:
+            if self.bucket is not None:
+                await self.queue.wait()
+                await self.bucket.acquire()
+            batch = await self._batch()
+            stop = None in batch
+            batch = [message for message in batch if message is not None]
+            if batch:
+                await self._write(batch)
+            if stop:
+                return
+
+    async def _drain(self):
+        attempts = 0
+        while True:
+            rows = self.spool.peek(self.name, self.batch_size)
+            if not rows:
+                if self.stopping:
+                    return
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                if self.batch_interval:
+                    await asyncio.sleep(self.batch_interval)
+                continue
+
+            if self.bucket is not None and await self.bucket.acquire():
+                # more urgent messages may have been spooled meanwhile
+                rows = self.spool.peek(self.name, self.batch_size)
+
+            done = await self._write([(title, content) for _, title, content in rows])
+            if done:
+                self.spool.ack(self.name, [row[0] for row in rows[:done]])
+                attempts = 0
+            if done == len(rows):
+                continue
+
+            rows = rows[done:]
+            attempts += 1
+            if self.max_attempts and attempts >= self.max_attempts:
+                self.logger.error("sink %s drop %d spooled messages after %d attempts",
+                                  self.name, len(rows), attempts)
+                self.spool.ack(self.name, [row[0] for row in rows])
+                self.dropped.inc(len(rows))
+                attempts = 0
+                continue
+            if self.stopping:
+                # the rest is delivered after the restart
+                return
+            await asyncio.sleep(self._backoff(attempts))
+
+    async def write(self, messages):
+        raise NotImplementedError
+
+    async def stop(self):
+        # the worker writes what was queued before it stops, a spooled sink
+        # stops at the first failure and keeps the rest in the spool
+        if self.spool is not None:
+            self.stopping = True
+            self.wakeup.set()
+        else:
+            self.queue.put_nowait(None, STOP)
+        await self.worker
+        await self.close()
+
+    async def close(self):
+        pass
+
+
+class LogSink(Sink):
+    TYPE = "log"
+    BATCH_SIZE = 100
+
+    async def write(self, messages):
+        for title, content in messages:
+            self.logger.info("%s:%s" % (title, content))
+
+
+class DiscordSink(Sink):
+    TYPE = "discord"
+    BATCH_SIZE = DiscordNotifier.MAX_EMBEDS
+    DURABLE = True
+
+    def __init__(self, webhook, username=None, **options):
+        super(DiscordSink, self).__init__(**options)
+        self.webhook = webhook
+        self.username = username
+        self.notifier = DiscordNotifier(logger=self.logger)
+
+    async def write(self, messages):
+        try:
+            delivered = await self.notifier.send_batch(self.webhook, messages, username=self.username)
+        except WebhookRejected as e:
+            raise RejectedError(str(e), e.delivered)
+        if delivered < len(messages):
+            raise DeliveryError("discord webhook did not accept the batch", delivered)
+
+    async def close(self):
+        await self.notifier.close()
+
+
+class HttpSink(Sink):
+    """POST every batch as JSON to a generic webhook, retrying 429 and 5xx."""
+    TYPE = "webhook"
+    BATCH_SIZE = 100
+    DURABLE = True
+    MAX_RETRY = 5
+
+    def __init__(self, url, timeout=10, maxretry=MAX_RETRY, **options):
+        super(HttpSink, self).__init__(**options)
+        self.url = url
+        self.timeout = timeout
+        self.maxretry = maxretry
+        self.session = None
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    def _payload(self, messages):
+        return {"messages": [{"title": title, "content": content} for title, content in messages]}
+
+    async def _post(self, url, payload):
+        for tried in range(self.maxretry):
+            delay = self._backoff(tried)
+            try:
+                async with self._get_session().post(url, json=payload) as resp:
+                    if resp.status < 300:
+                        return True
+                    body = await resp.text()
+                    if resp.status == 429:
+                        retry_after = resp.headers.get("Retry-After")
+                        if retry_after is not None:
+                            delay = float(retry_after)
+                    elif resp.status < 500:
+                        raise RejectedError("sink %s rejected with %d: %s" % (self.name, resp.status, body))
+                    self.logger.info("sink %s got %d (%d/%d)", self.name, resp.status, tried + 1, self.maxretry)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.logger.info("sink %s got exception: %s (%d/%d)", self.name, repr(e), tried + 1, self.maxretry)
+            await asyncio.sleep(delay)
+
+        self.logger.error("sink %s gave up on a batch after %d attempts", self.name, self.maxretry)
+        return False
+
+    async def write(self, messages):
+        if not await self._post(self.url, self._payload(messages)):
+            raise DeliveryError("%s did not accept the batch" % self.url)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class TelegramSink(HttpSink):
+    TYPE = "telegram"
+    BATCH_SIZE = 20
+    ENDPOINT = "https://api.telegram.org"
+    MAX_LENGTH = 4096
+
+    def __init__(self, token, chat_id, endpoint=ENDPOINT, **options):
+        super(TelegramSink, self).__init__("%s/bot%s/sendMessage" % (endpoint, token), **options)
+        self.chat_id = chat_id
+
+    def _chunk(self, messages):
+        # one sendMessage per 4096 characters of messages
+        texts, length = [], 0
+        for title, content in messages:
+            text = ("%s\n%s" % (title, content))[:self.MAX_LENGTH]
+            if texts and length + len(text) + 2 > self.MAX_LENGTH:
+                yield "\n\n".join(texts), len(texts)
+                texts, length = [], 0
+            texts.append(text)
+            length += len(text) + 2
+        if texts:
+            yield "\n\n".join(texts), len(texts)
+
+    async def write(self, messages):
+        # stop at the first failed sendMessage, the delivered ones are not sent again
+        delivered = 0
+        for text, count in self._chunk(messages):
+            try:
+                ok = await self._post(self.url, {"chat_id": self.chat_id, "text": text})
+            except RejectedError as e:
+                e.delivered = delivered
+                raise
+            if not ok:
+                raise DeliveryError("telegram did not accept the batch", delivered)
+            delivered += count
+
+
+class FileSink(Sink):
+    """Append one JSON line per message, flushed once per batch."""
+    TYPE = "file"
+    BATCH_SIZE = 1000
+
+    def __init__(self, path, **options):
+        super(FileSink, self).__init__(**options)
+        self.path = path
+        self.file = open(path, "a")
+
+    async def write(self, messages):
+        now = time.time()
+        for title, content in messages:
+            self.file.write(json.dumps({"ts": now, "title": title, "content": content}) + "\n")
+        self.file.flush()
+
+    async def close(self):
+        self.file.close()
+
+
+class LocalBus(object):
+    """In-process stand-in for a message bus, subscribers get thread-safe queues per topic."""
+
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def subscribe(self, topic, maxsize=0):
+        q = queue.Queue(maxsize=maxsize)
+        with self.lock:
+            self.subscribers[topic].append(q)
+        return q
+
+    def unsubscribe(self, topic, q):
+        with self.lock:
+            self.subscribers[topic].remove(q)
+
+    def publish(self, topic, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(topic, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass
+
+
+BUS = LocalBus()
+
+
+class BusSink(Sink):
+    TYPE = "bus"
+    BATCH_SIZE = 100
+
+    def __init__(self, topic="executions", bus=BUS, **options):
+        super(BusSink, self).__init__(**options)
+        self.topic = topic
+        self.bus = bus
+
+    async def write(self, messages):
+        for message in messages:
+            self.bus.publish(self.topic, message)
+
+
+SINK_TYPES = dict((cls.TYPE, cls) for cls in [LogSink, DiscordSink, HttpSink, TelegramSink, FileSink, BusSink])
+
+
+def build_sinks(configs, logger=logger):
+    """Create the sinks of the "sinks" section of the config, dicts with a type and its options."""
+    sinks = []
+    for config in configs:
+        options = dict(config)
+        kind = options.pop("type", None)
+        if kind not in SINK_TYPES:
+            raise Exception("unknow sink type %s, expect one of %s" % (kind, sorted(SINK_TYPES)))
+        sinks.append(SINK_TYPES[kind](logger=logger, **options))
+
+    names = [sink.name for sink in sinks]
+    if len(set(names)) != len(names):
+        raise Exception("sink names should be unique: %s" % names)
+    return sinks
+
+
+class SinkPipeline(object):
+    """
+    Fan the notifications out to the sinks.
+
+    The sinks run on their own loop in a daemon thread and publish() only
+    queues, so neither the websocket loop nor a sink waits on another sink.
+    With a spool the durable sinks keep their messages on disk until they
+    were delivered, across restarts.
+    """
+
+    def __init__(self, sinks, spool=None, logger=logger):
+        self.sinks = sinks
+        self.spool = spool
+        self.logger = logger
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        for sink in self.sinks:
+            sink.start(self.spool)
+        self.loop.call_soon(self.started.set)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def _put(self, channel, messages, names, priority):
+        for sink in self.sinks:
+            if (names is None or sink.name in names) and sink.accepts(channel):
+                sink.put(messages, priority, channel)
+
+    def publish(self, channel, messages, names=None, priority=NORMAL):
+        """
+        Queue (title, content) messages of an account, safe to call from any thread.
+
+        With names only the sinks of those names get them, as chosen by the routes.
+        """
+        self.loop.call_soon_threadsafe(self._put, channel, list(messages), names, priority)
+
+    def _set_routes(self, routes):
+        for sink in self.sinks:
+            if sink.name in routes:
+                accounts = routes[sink.name]
+                sink.accounts = set(accounts) if accounts else None
+
+    def set_routes(self, routes):
+        """Replace the accounts of the sinks by name, safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._set_routes, dict(routes))
+
+    def stats(self):
+        return self.spool.stats() if self.spool is not None else {}
+
+    def stop(self, timeout=None):
+        async def stop():
+            await asyncio.gather(*[sink.stop() for sink in self.sinks], return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(stop(), self.loop).result(timeout)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
+            if self.spool is not None:
+                self.spool.close()
@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+import time
+
+
+class Spool(object):
+    """
+    Durable queues of outbound messages, one per sink, in a SQLite database.
+
+    The database runs in WAL mode with synchronous=NORMAL, so an append is one
+    short transaction which survives a crash of the process. Messages are read
+    back by priority, in order within a priority, with peek() and deleted with
+    ack() once they were delivered. The number of rows per sink is kept in
+    memory, so size() is cheap enough to check on every append.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # the metrics are scraped from another thread, every use holds the lock
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, sink TEXT NOT NULL, ts REAL NOT NULL, "
+            "title TEXT NOT NULL, content TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 2)")
+        # spools written before the priorities were added
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(spool)")]
+        if "priority" not in columns:
+            self.conn.execute("ALTER TABLE spool ADD COLUMN priority INTEGER NOT NULL DEFAULT 2")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS spool_sink ON spool (sink, id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS spool_priority ON spool (sink, priority, id)")
+        self.sizes = dict(self.conn.execute("SELECT sink, COUNT(*) FROM spool GROUP BY sink").fetchall())
+
+    def append(self, sink, messages, ts=None, priority=2):
+        ts = ts if ts is not None else time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT INTO spool (sink, ts, title, content, priority) VALUES (?, ?, ?, ?, ?)",
+                                      [(sink, ts, title, content, priority) for title, content in messages])
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            self.sizes[sink] = self.sizes.get(sink, 0) + len(messages)
+
+    def peek(self, sink, n):
+        """Return up to n (id, title, content) rows of a sink, the most urgent and then the oldest first."""
+        with self.lock:
+            return self.conn.execute("SELECT id, title, content FROM spool WHERE sink = ? "
+                                     "ORDER BY priority, id LIMIT ?", (sink, n)).fetchall()
+
+    def ack(self, sink, ids):
+        """Delete the rows of a sink by id."""
+        with self.lock:
+            deleted = self.conn.executemany("DELETE FROM spool WHERE sink = ? AND id = ?",
+                                            [(sink, i) for i in ids]).rowcount
+            self.sizes[sink] = self.sizes.get(sink, 0) - deleted
+
+    def size(self, sink):
+        return self.sizes.get(sink, 0)
+
+    def age(self, sink):
+        """Seconds the oldest row of a sink has been waiting, 0 if there is none."""
+        with self.lock:
+            oldest = self.conn.execute("SELECT ts FROM spool WHERE sink = ? ORDER BY id LIMIT 1",
+                                       (sink,)).fetchone()
+        return time.time() - oldest[0] if oldest else 0
+
+    def stats(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT sink, COUNT(*), MIN(ts) FROM spool GROUP BY sink").fetchall()
+        now = time.time()
+        return dict((sink, {'size': size, 'age': now - oldest}) for sink, size, oldest in rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
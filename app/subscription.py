@@ -0,0 +1,127 @@
+from collections import OrderedDict
+
+
+class SubscriptionManager(object):
+    """
+    Wire state of the subscriptions of every channel.
+
+    Topics added to a channel are collected until the next flush, which returns
+    one open, one authKey and one subscribe request per channel no matter how
+    many topics were added. Acknowledgements move a subscription from pending
+    to subscribed so readiness can be derived from here.
+    """
+    PENDING = "pending"
+    SUBSCRIBED = "subscribed"
+    FAILED = "failed"
+
+    # auth states of private channels
+    UNSENT = "unsent"
+    VERIFIED = "verified"
+
+    def __init__(self):
+        self.channels = OrderedDict()
+
+    def _channel(self, channel, private):
+        state = self.channels.get(channel)
+        if state is None:
+            state = {
+                'opened': False,
+                'auth': self.UNSENT if private else None,
+                'subscriptions': OrderedDict(),
+                'subscribe': [],
+                'unsubscribe': [],
+            }
+            self.channels[channel] = state
+        return state
+
+    def add(self, channel, subscription, private=False):
+        state = self._channel(channel, private)
+        if subscription in state['subscriptions']:
+            return False
+        state['subscriptions'][subscription] = self.PENDING
+        state['subscribe'].append(subscription)
+        return True
+
+    def remove(self, channel, subscription):
+        state = self.channels.get(channel)
+        if state is None or subscription not in state['subscriptions']:
+            return False
+        del state['subscriptions'][subscription]
+        if subscription in state['subscribe']:
+            # it was never sent
+            state['subscribe'].remove(subscription)
+        else:
+            state['unsubscribe'].append(subscription)
+        return True
+
+    def names(self, channel):
+        state = self.channels.get(channel)
+        return list(state['subscriptions']) if state is not None else []
+
+    def has_channel(self, channel):
+        return channel in self.channels
+
+    def has(self, channel, subscription):
+        state = self.channels.get(channel)
+        return state is not None and subscription in state['subscriptions']
+
+    def drop(self, channel):
+        return self.channels.pop(channel, None) is not None
+
+    def reset(self):
+        # the connection was lost, everything has to be sent again
+        for state in self.channels.values():
+            state['opened'] = False
+            if state['auth'] is not None:
+                state['auth'] = self.UNSENT
+            for subscription in state['subscriptions']:
+                state['subscriptions'][subscription] = self.PENDING
+            state['subscribe'] = list(state['subscriptions'])
+            state['unsubscribe'] = []
+
+    def flush(self):
+        """Return the requests not sent yet as (op, channel, args) tuples."""
+        requests = []
+        for channel, state in self.channels.items():
+            if not state['opened']:
+                requests.append(("open", channel, None))
+                state['opened'] = True
+            if state['auth'] == self.UNSENT:
+                requests.append(("authKey", channel, None))
+                state['auth'] = self.PENDING
+            if state['unsubscribe']:
+                requests.append(("unsubscribe", channel, state['unsubscribe']))
+                state['unsubscribe'] = []
+            if state['subscribe']:
+                requests.append(("subscribe", channel, state['subscribe']))
+                state['subscribe'] = []
+        return requests
+
+    def ack_auth(self, channel, ok=True):
+        state = self.channels.get(channel)
+        if state is not None and state['auth'] is not None:
+            state['auth'] = self.VERIFIED if ok else self.FAILED
+
+    def ack(self, channel, subscription, ok=True):
+        state = self.channels.get(channel)
+        if state is not None and subscription in state['subscriptions']:
+            state['subscriptions'][subscription] = self.SUBSCRIBED if ok else self.FAILED
+
+    def _select(self, status):
+        requests = []
+        for channel, state in self.channels.items():
+            if state['auth'] == status or (status == self.PENDING and state['auth'] == self.UNSENT):
+                requests.append(("auth", channel))
+            for subscription, s in state['subscriptions'].items():
+                if s == status:
+                    requests.append(("subscribe", channel, subscription))
+        return requests
+
+    def pending(self):
+        return self._select(self.PENDING)
+
+    def failed(self):
+        return self._select(self.FAILED)
+
+    def acknowledged(self):
+        return self._select(self.SUBSCRIBED)
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from types import MappingProxyType
+
+
+class Table(object):
+    """
+    Keyed image of one BitMEX table.
+
+    The index is built from the `keys` of the partial message, so insert, update
+    and delete are O(1). When the table grows over max_len the oldest rows are
+    evicted first.
+
+    Rows are never changed in place, an update replaces the row with an updated
+    copy, so what get() and snapshot() return stays as it was when taken while
+    view() follows the table. The image is applied when a frame is received,
+    before the handlers run from the dispatcher queues, so a handler may see
+    rows of frames newer than the payload it handles.
+    """
+
+    def __init__(self, name, max_len=None):
+        self.name = name
+        self.max_len = max_len
+        self.keys = None
+        self.types = {}
+        self.rows = OrderedDict()
+        self.seq = 0
+
+    @property
+    def ready(self):
+        return self.keys is not None
+
+    def _key(self, row):
+        if not self.keys:
+            # tables without keys (trade, liquidation...) are append only
+            self.seq += 1
+            return self.seq
+        return tuple(row.get(k) for k in self.keys)
+
+    def _evict(self):
+        if self.max_len is None:
+            return
+        while len(self.rows) > self.max_len:
+            self.rows.popitem(last=False)
+
+    def partial(self, keys, types, data):
+        self.keys = list(keys or [])
+        self.types = types or {}
+        self.rows = OrderedDict()
+        self.insert(data)
+
+    def insert(self, data):
+        for row in data:
+            # keep our own copy, the payload is also handed to the handlers
+            self.rows[self._key(row)] = dict(row)
+        self._evict()
+
+    def update(self, data):
+        if not self.keys:
+            return
+        for row in data:
+            key = self._key(row)
+            current = self.rows.get(key)
+            if current is not None:
+                # copy on update, the old row may still be held by a snapshot
+                updated = dict(current)
+                updated.update(row)
+                self.rows[key] = updated
+
+    def delete(self, data):
+        if not self.keys:
+            return
+        for row in data:
+            self.rows.pop(self._key(row), None)
+
+    def get(self, *key):
+        row = self.rows.get(key)
+        return MappingProxyType(row) if row is not None else None
+
+    def view(self):
+        return MappingProxyType(self.rows)
+
+    def snapshot(self):
+        """Read-only rows as of now, later frames do not change them."""
+        return tuple(MappingProxyType(row) for row in list(self.rows.values()))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class TableStore(object):
+    def __init__(self, max_len=None):
+        self.max_len = max_len
+        self.limits = {}
+        self.tables = {}
+
+    def set_limit(self, table, max_len):
+        self.limits[table] = max_len
+        for (_, name), t in self.tables.items():
+            if name == table:
+                t.max_len = max_len
+
+    def get(self, channel, table):
+        return self.tables.get((channel, table))
+
+    def drop(self, channel):
+        for key in [key for key in self.tables if key[0] == channel]:
+            del self.tables[key]
+
+    def apply(self, channel, table, payload):
+        t = self.tables.get((channel, table))
+        if t is None:
+            t = Table(table, self.limits.get(table, self.max_len))
+            self.tables[(channel, table)] = t
+
+        action = payload.get("action")
+        data = payload.get("data", [])
+        if action == "partial":
+            t.partial(payload.get("keys"), payload.get("types"), data)
+        elif not t.ready:
+            # updates before the partial can not be applied
+            return t
+        elif action == "insert":
+            t.insert(data)
+        elif action == "update":
+            t.update(data)
+        elif action == "delete":
+            t.delete(data)
+
+        return t